@@ -4,10 +4,21 @@
 #   - config/Ports.yml
 #   - config/Modules.yml
 #
-import yaml
+import os
 import re
 import subprocess
-from itertools import chain
+import marshal
+import tempfile
+import hashlib
+
+# Cache dir for the parsed config files (see __load_yml)
+cachedir = os.environ.get('MADPACK_CACHE_DIR', 
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 
+                 'madpack'))
+
+# YAML loader used to parse the config files: 'CSafeLoader (libyaml)' or
+# 'SafeLoader (pure Python)'; None as long as all files came from the cache
+yaml_loader = None
 
 ##
 # A Python exception class for our use
@@ -18,6 +29,92 @@ class MadPackConfigError(Exception):
      def __str__(self):
          return repr(self.value)
 
+## 
+# Return the YAML loader class to use: the libyaml based CSafeLoader if the
+# _yaml extension is available, otherwise the pure-Python SafeLoader
+##
+def __get_yaml_loader():
+
+    global yaml_loader
+    import yaml
+    try:
+        import _yaml
+        loader = yaml.CSafeLoader
+        yaml_loader = 'CSafeLoader (libyaml)'
+    except (ImportError, AttributeError):
+        loader = yaml.SafeLoader
+        yaml_loader = 'SafeLoader (pure Python)'
+    return loader
+
+## 
+# Read an object from a marshalled cache file
+# @param cachefile name of the file in cachedir
+# @return the object or None if the file is missing or unreadable
+##
+def __read_cache(cachefile):
+
+    try:
+        f = open(os.path.join(cachedir, cachefile), 'rb')
+        try:
+            return marshal.load(f)
+        finally:
+            f.close()
+    except:
+        return None
+
+## 
+# Write an object to a marshalled cache file (atomically, through a 
+# temporary file). Caching is skipped silently if cachedir is not writable.
+# @param cachefile name of the file in cachedir
+# @param obj the object
+##
+def __write_cache(cachefile, obj):
+
+    tmpname = None
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        (fd, tmpname) = tempfile.mkstemp('.tmp', 'yml.', cachedir)
+        f = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump(obj, f)
+        finally:
+            f.close()
+        os.rename(tmpname, os.path.join(cachedir, cachefile))
+    except:
+        if tmpname and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+## 
+# Load a YML file. The parsed content is cached in a marshalled file
+# (in cachedir) and reused as long as the mtime and size of the YML file
+# do not change. The yaml package is only imported on a cache miss, and
+# the file is then parsed with libyaml when available (see __get_yaml_loader).
+# @param fname path of the YML file
+##
+def __load_yml(fname):
+
+    fname = os.path.abspath(fname)
+    st = os.stat(fname)
+    stamp = (st.st_mtime, st.st_size)
+    cachefile = re.sub('[^A-Za-z0-9_.-]', '_', fname.strip('/')) + '.marshal'
+
+    # Cache hit
+    cached = __read_cache(cachefile)
+    if cached and tuple(cached[0]) == stamp:
+        return cached[1]
+
+    # Cache miss: parse the file
+    import yaml
+    f = open(fname)
+    try:
+        conf = yaml.load(f, Loader=__get_yaml_loader())
+    finally:
+        f.close()
+
+    __write_cache(cachefile, (stamp, conf))
+    return conf
+
 ## 
 # Load version string from Version.yml file.
 # Typical Version.yml file:
@@ -27,7 +124,7 @@ class MadPackConfigError(Exception):
 def get_version(configdir):
 
     try:
-        conf = yaml.load(open(configdir + '/Version.yml'))
+        conf = __load_yml(configdir + '/Version.yml')
     except:
         print "configyml : ERROR : missing or malformed Version.yml"
         exit(2)
@@ -48,7 +145,7 @@ def get_version(configdir):
 def get_ports(configdir):
 
     try:
-        conf = yaml.load(open(configdir + '/Ports.yml'))
+        conf = __load_yml(configdir + '/Ports.yml')
     except:
         print "configyml : ERROR : missing or malformed Ports.yml"
         exit(2)
@@ -65,16 +162,17 @@ def get_ports(configdir):
 ## 
 # Load modules
 #
-# @param configdir the directory where we can find the [port_id].yml file
-# @param id the ID of the specific DB port
-# @param src the directory of the source code for a specific port
+# @param confdir the directory where we can find the Modules.yml file
+# @param overlays list of more specific config directories (e.g. of a DB 
+#        port): the modules of their Modules.yml files (if any) replace the 
+#        modules of the same name or are added to the list
 ##
-def get_modules( confdir):
+def get_modules( confdir, overlays = None):
 
     fname = "Modules.yml"
     
     try:
-        conf = yaml.load( open( confdir + '/' + fname))
+        conf = __load_yml(confdir + '/' + fname)
     except:
         print "configyml : ERROR : missing or malformed " + confdir + '/' + fname
         raise Exception
@@ -84,55 +182,216 @@ def get_modules( confdir):
     except:
         print "configyml : ERROR : missing modules section in " + fname
         raise Exception
+
+    for odir in overlays or []:
+        if not os.path.isfile(odir + '/' + fname):
+            continue
+        try:
+            overlay = __load_yml(odir + '/' + fname)
+            overlay['modules']
+        except:
+            print "configyml : ERROR : missing or malformed " + odir + '/' + fname
+            raise Exception
+        conf = merge_modules(conf, overlay)
         
     conf = topsort_modules( conf)
     
     return conf
 
 ##
-# Helper function
-##    
-def flatten(listOfLists):
-    "Flatten one level of nesting"
-    return chain.from_iterable(listOfLists)
+# Return the SHA-1 of each file (None for a missing file)
+# @param fnames list of file paths
+##
+def __hash_files(fnames):
+
+    hashes = []
+    for fname in fnames:
+        try:
+            f = open(fname, 'rb')
+            try:
+                hashes.append(hashlib.sha1(f.read()).hexdigest())
+            finally:
+                f.close()
+        except IOError:
+            hashes.append(None)
+    return hashes
+
+##
+# Load the madpack configuration from one compiled snapshot of the config
+# files, kept in cachedir for each config dir. The snapshot holds Ports.yml 
+# and Version.yml of configdir, and the sorted modules of every port and 
+# version they were requested for (see get_config_modules). It is reused as
+# long as the SHA-1 of Ports.yml and Version.yml is unchanged: the YML files 
+# are then neither parsed nor sorted again.
+# @param configdir the directory of Ports.yml and Version.yml
+# @return a dictionary with keys 'ports', 'version' and 'modules' (the
+#         cached modules, see get_config_modules)
+##
+def get_config(configdir):
+
+    configdir = os.path.abspath(configdir)
+    hashes = __hash_files([configdir + '/Ports.yml', configdir + '/Version.yml'])
+    cachefile = 'snapshot.' + hashlib.sha1(configdir).hexdigest() + '.marshal'
+    cached = __read_cache(cachefile)
+    if cached and cached.get('configdir') == configdir \
+            and list(cached.get('hashes', [])) == hashes:
+        return cached
+
+    config = { 'configdir': configdir,
+               'hashes': hashes,
+               'ports': get_ports(configdir), 
+               'version': get_version(configdir),
+               'modules': {} }
+    __write_cache(cachefile, config)
+    return config
+
+##
+# Return the sorted modules of a DB port (see get_modules) from the config
+# snapshot returned by get_config. The modules are compiled and added to 
+# the snapshot the first time a port and version asks for them, and again
+# when one of the Modules.yml files changes.
+# @param config the config snapshot returned by get_config
+# @param modconfdir the directory of Modules.yml
+# @param overlays list of more specific config directories
+# @param portid the ID of the DB port
+# @param dbver the version of the DB
+# @return the madpack configuration with the sorted modules
+##
+def get_config_modules(config, modconfdir, overlays, portid, dbver):
+
+    overlays = overlays or []
+    hashes = __hash_files([modconfdir + '/Modules.yml'] + 
+                          [odir + '/Modules.yml' for odir in overlays])
+    key = repr([os.path.abspath(d) for d in [modconfdir] + overlays] 
+               + [portid, dbver])
+    cached = config['modules'].get(key)
+    if cached and list(cached[0]) == hashes:
+        return cached[1]
+
+    conf = get_modules(modconfdir, overlays)
+    config['modules'][key] = (hashes, conf)
+    __write_cache('snapshot.' + hashlib.sha1(config['configdir']).hexdigest() 
+                  + '.marshal', config)
+    return conf
+
+##
+# Merge the modules of an overlay configuration into conf: a module of the
+# overlay replaces the module of the same name, new modules are appended
+# @param conf a madpack configuration
+# @param overlay a madpack configuration
+##
+def merge_modules(conf, overlay):
+
+    index = dict()
+    for i, m in enumerate(conf['modules']):
+        index[m['name']] = i
+    for m in overlay['modules'] or []:
+        if m['name'] in index:
+            conf['modules'][index[m['name']]] = m
+        else:
+            index[m['name']] = len(conf['modules'])
+            conf['modules'].append(m)
+    return conf
 
 ## 
-# Quick and dirty topological sort
-# Currently does dumb cycle detection.
+# Topological sort (Kahn's algorithm), linear in the number of nodes and
+# edges. The level of a node is 0 if it has no dependencies, otherwise 1 +
+# the highest level of its dependencies; nodes that appear only as
+# dependencies get level 0. Every dependency of a node is on a lower level,
+# so the nodes of one level can be installed concurrently (madpack --jobs).
+# Note: the former algorithm placed the nodes above a dependency that is
+# not a key one level higher; these levels are the lowest valid ones.
 # @param depdict an edgelist dictionary, e.g. {'b': ['a'], 'z': ['m', 'n'], 'm': ['a', 'b']}
+# @return a dictionary {node: level}
+# @raise MadPackConfigError listing the strongly connected components 
+#        (cycles) if the graph is not acyclic
 ##
 def topsort(depdict):
     out = dict()
-    candidates = set()
-    curlevel = 0
-
-    while len(depdict) > 0:
-        found = 0  # flag to check if we find anything new this iteration
-        newdepdict = dict()
-        # find the keys with no values
-        keynoval = filter(lambda t: t[1] == [], depdict.iteritems())
-        # find the values that are not keys
-        valnotkey = set(flatten(depdict.itervalues())) - set(depdict.iterkeys())
-
-        candidates = set([k[0] for k in keynoval]) | valnotkey
-        for c in candidates:
-            if c not in out:
-                found += 1
-                out[c] = curlevel
+    indegree = dict()
+    dependents = dict()
+    for k, deps in depdict.iteritems():
+        indegree.setdefault(k, 0)
+        for v in set(deps or []):
+            indegree[k] += 1
+            indegree.setdefault(v, 0)
+            dependents.setdefault(v, []).append(k)
 
-        for k in depdict.iterkeys():
-            if depdict[k] != []:
-                newdepdict[k] = filter(lambda v: v not in valnotkey, depdict[k])
-        # newdepdict = dict(newdepdict)
-        if newdepdict == depdict:
-            raise MadPackConfigError(str(depdict))
-        else:
-            depdict = newdepdict
-        if found > 0:
-            curlevel += 1
+    todo = [k for k in indegree if indegree[k] == 0]
+    for k in todo:
+        out[k] = 0
+    while len(todo) > 0:
+        k = todo.pop()
+        for d in dependents.get(k, []):
+            out[d] = max(out.get(d, 0), out[k] + 1)
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                todo.append(d)
+
+    if len(out) < len(indegree):
+        remaining = dict()
+        for k in indegree:
+            if k not in out:
+                remaining[k] = [v for v in depdict.get(k) or [] if v not in out]
+        raise MadPackConfigError("; ".join(
+            [" <-> ".join(c) for c in strongly_connected(remaining)]))
     
     return out
 
+## 
+# Strongly connected components (Tarjan's algorithm, iterative) of a graph,
+# keeping only the components that contain a cycle
+# @param depdict an edgelist dictionary
+# @return a sorted list of sorted lists of nodes
+##
+def strongly_connected(depdict):
+    index = dict()
+    lowlink = dict()
+    stack = []
+    onstack = set()
+    components = []
+    counter = 0
+
+    for root in sorted(depdict):
+        if root in index:
+            continue
+        work = [(root, 0)]
+        while len(work) > 0:
+            node, i = work.pop()
+            if i == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                onstack.add(node)
+            deps = depdict.get(node, [])
+            recurse = False
+            while i < len(deps):
+                v = deps[i]
+                i += 1
+                if v not in index:
+                    work.append((node, i))
+                    work.append((v, 0))
+                    recurse = True
+                    break
+                elif v in onstack:
+                    lowlink[node] = min(lowlink[node], index[v])
+            if recurse:
+                continue
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    v = stack.pop()
+                    onstack.discard(v)
+                    component.append(v)
+                    if v == node:
+                        break
+                if len(component) > 1 or node in deps:
+                    components.append(sorted(component))
+            if len(work) > 0:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+    return sorted(components)
+
 ## 
 # Top-sort the modules in conf
 # @param conf a madpack configuration
@@ -141,10 +400,7 @@ def topsort_modules(conf):
 
     depdict = dict()    
     for m in conf['modules']:
-        try:
-            depdict[m['name']] = m['depends']
-        except:
-            depdict[m['name']] = []        
+        depdict[m['name']] = m.get('depends') or []
     try:
         module_dict = topsort(depdict)
     except MadPackConfigError as e:
@@ -161,5 +417,53 @@ def topsort_modules(conf):
         for m in missing:
             print  "    " + m + " (required by " + str(list(inverted[m])) + ")"
         exit(2)
-    conf['modules'] = sorted(conf['modules'], key=lambda m:module_dict[m['name']])
+    # Keep the dependency level of each module: modules of the same
+    # level do not depend on each other and can be installed in parallel
+    for m in conf['modules']:
+        m['level'] = module_dict[m['name']]
+    conf['modules'] = sorted(conf['modules'], key=lambda m:m['level'])
+    return conf
+
+## 
+# Select a subset of the modules in conf, together with all the modules
+# they depend on (directly or indirectly)
+# @param conf a madpack configuration (sorted by topsort_modules)
+# @param include list of module names to select (None: all modules)
+# @param exclude list of module names to leave out (None: none)
+# @param strict if True, excluding a module required by a selected module
+#        is an error
+##
+def select_modules(conf, include, exclude, strict):
+
+    depdict = dict()
+    for m in conf['modules']:
+        depdict[m['name']] = m.get('depends') or []
+    include = include or []
+    exclude = exclude or []
+    for name in include + exclude:
+        if name not in depdict:
+            raise MadPackConfigError("unknown module: " + name)
+
+    # Add the dependency closure of the selected modules
+    if include:
+        selected = set()
+        todo = list(include)
+        while len(todo) > 0:
+            name = todo.pop()
+            if name not in selected:
+                selected.add(name)
+                todo.extend(depdict[name])
+    else:
+        selected = set(depdict.iterkeys())
+
+    for name in exclude:
+        selected.discard(name)
+    if strict:
+        for name in selected:
+            required = set(depdict[name]) & set(exclude)
+            if len(required) > 0:
+                raise MadPackConfigError("module %s requires excluded module(s): %s" 
+                                         % (name, ", ".join(sorted(required))))
+
+    conf['modules'] = filter(lambda m: m['name'] in selected, conf['modules'])
     return conf
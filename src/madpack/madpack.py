@@ -10,9 +10,13 @@ import glob
 import traceback
 import subprocess
 import datetime
+import time
 from time import strftime
 import tempfile
 import shutil
+import threading
+import Queue
+import hashlib
 
 # Required Python version
 py_min_ver = [2,6]
@@ -43,19 +47,31 @@ this = os.path.basename(sys.argv[0])    # name of this script
 maddir_conf = maddir + "/config"           # Config dir
 maddir_lib  = maddir + "/lib/libmadlib.so" # C/C++ libraries 
 
-# Read the config files
-ports = configyml.get_ports(maddir_conf )  # object made of Ports.yml
-rev = configyml.get_version(maddir_conf )  # MADlib OS-level version
+# Read the config files (Modules.yml is read in main, see get_config_modules)
+config = configyml.get_config(maddir_conf) # snapshot of the config files
+ports = config['ports']                    # object made of Ports.yml
+rev = config['version']                    # MADlib OS-level version
 portid_list = []
 for port in ports:
     portid_list.append(port)
 
 # Global variables
 portid = None       # Target port ID (eg: pg90, gp40)
-dbconn = None       # DB Connection object
+dbconn = None       # DB Connection object (PyGreSQL), None if using psql
+dbconn_lock = threading.Lock()  # Serializes queries on dbconn (--jobs)
+sqlcmd_checked = set()  # DB command-line utilities found in PATH
 dbver = None        # DB version
+dbinfo = None       # DB properties read by __get_dbinfo
 con_args = {}       # DB connection arguments
 verbose = None      # Verbose flag
+jobs = 1            # Max number of modules processed concurrently
+cachedir = None     # Cache dir for m4-preprocessed SQL files (None: no cache)
+sql_hashes = {}     # SHA-1 of the preprocessed SQL of each file run
+sql_times = {}      # Execution time (ms) of each SQL file run
+profile_file = None # JSON file for statement timings (None: no profiling)
+profile = []        # Statement timings collected in profiling mode
+module_transaction = False  # Install each module in a single transaction
+assume_yes = False  # Answer Y to the confirmation prompts
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Create a temp dir 
@@ -95,26 +111,168 @@ def __info(msg, verbose):
         print this + ' : INFO : ' + msg
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-# Runs a SQL query on the target platform DB
-# using the default command-line utility.
-# Very limited: 
-#   - no text output with "new line" characters allowed
+# Call a function for every item of a list using up to
+# max_jobs worker threads. With a single job items are 
+# processed in order and the first failure stops the loop.
+# @param func function to call (raises an exception on failure)
+# @param items list of arguments for func
+# @param max_jobs max number of concurrent calls
+# @returns the list of items for which func failed
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_parallel(func, items, max_jobs):
+
+    failed = []
+
+    # Sequential mode
+    if max_jobs <= 1 or len(items) <= 1:
+        for item in items:
+            try:
+                func(item)
+            except Exception:
+                failed.append(item)
+                break
+        return failed
+
+    # Parallel mode
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except:
+                # Also catches SystemExit raised by __error(msg, True)
+                lock.acquire()
+                failed.append(item)
+                lock.release()
+
+    threads = []
+    for i in range(min(max_jobs, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    return failed
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Make sure the DB command-line utility is available.
+# The lookup is done only once per run.
+# @param sqlcmd name of the command-line utility
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __check_sqlcmd(sqlcmd):
+    if sqlcmd in sqlcmd_checked:
+        return
+    std, err = subprocess.Popen(['which', sqlcmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    if std == '':
+        __error("Command not found: %s" % sqlcmd, True)
+    sqlcmd_checked.add(sqlcmd)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Open the database connection used by __run_sql_query for
+# the rest of the run. Uses the PyGreSQL driver if it can be
+# imported, otherwise all queries fall back to the DB 
+# command-line utility (one process per query).
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_connect():
+
+    global dbconn
+    dbconn = None
+
+    # Postgres & Greenplum
+    if portid == 'greenplum' or portid == 'postgres':
+
+        try:
+            try:
+                from pygresql import pg
+            except ImportError:
+                import pg
+        except ImportError:
+            __info("> PyGreSQL not found, using psql for SQL queries", verbose)
+            return
+
+        try:
+            dbconn = pg.DB( dbname=con_args['database']
+                          , host=con_args['host'].split(':')[0]
+                          , port=int(con_args['host'].split(':')[1])
+                          , user=con_args['user']
+                          , passwd=con_args['password']
+                          )
+            dbconn.query("SET CLIENT_MIN_MESSAGES=error;")
+        except Exception, e:
+            __info("> PyGreSQL connection failed (%s), using psql for SQL queries" 
+                    % str(e).strip(), verbose)
+            dbconn = None
+            return
+
+        __info("> Connected using PyGreSQL", verbose)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Close the database connection opened by __db_connect
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_disconnect():
+
+    global dbconn
+    if dbconn is not None:
+        try:
+            dbconn.close()
+        except:
+            pass
+        dbconn = None
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Runs a SQL query on the target platform DB and yields the
+# result rows (dicts of col_name:col_value) as they arrive,
+# using the persistent driver connection (if open) or the 
+# default command-line utility.
+# Values are typed (NULL is None) with the driver connection,
+# and text (NULL is '') with the command-line utility.
 # @param sql query text to execute
 # @param show_error displays the SQL error msg
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def __run_sql_query(sql, show_error):
+def __iter_sql_query(sql, show_error):
+
+    # Driver connection
+    if dbconn is not None:
+        dbconn_lock.acquire()
+        try:
+            rv = dbconn.query(sql)
+        except Exception, e:
+            dbconn_lock.release()
+            if show_error:
+                __error("SQL command failed: \nSQL: %s \n%s" % (sql, str(e)), False)
+            raise Exception
+        dbconn_lock.release()
+
+        # DDL/DML statements return None or the number of affected rows
+        if rv is None or isinstance(rv, basestring):
+            return
+
+        cols = rv.listfields()
+        for row in rv.getresult():
+            yield dict(zip(cols, row))
+        return
 
     # Postgres & Greenplum
     if portid == 'greenplum' or portid == 'postgres':
     
-        # Define sqlcmd
+        # Define sqlcmd. Fields and records are separated by the ASCII 
+        # unit/record separators, so values may contain '|' and new lines
         sqlcmd = 'psql'
-        delimiter = '|'
+        delimiter = '\x1f'
+        recordsep = '\x1e'
         
         # Test the DB cmd line utility
-        std, err = subprocess.Popen(['which', sqlcmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if std == '':
-            __error("Command not found: %s" % sqlcmd, True)
+        __check_sqlcmd(sqlcmd)
         
         # Run the query
         runcmd = [ sqlcmd,
@@ -123,36 +281,281 @@ def __run_sql_query(sql, show_error):
                     '-d', con_args['database'],
                     '-U', con_args['user'],
                     '-F', delimiter,
+                    '-R', recordsep,
+                    '-P', 'footer=off',
                     '-Ac', "set CLIENT_MIN_MESSAGES=error; " + sql]
         runenv = os.environ
         runenv["PGPASSWORD"] = con_args['password']
-        std, err = subprocess.Popen(runcmd, env=runenv, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        errfile = tempfile.TemporaryFile()
+        proc = subprocess.Popen(runcmd, env=runenv, stdout=subprocess.PIPE, stderr=errfile)
+
+        # Convert the delimited output into dictionaries while reading it.
+        # The first record holds the column names, the last one ends 
+        # with a new line.
+        cols = None
+        buf = ''
+        while True:
+            chunk = os.read(proc.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            records = (buf + chunk).split(recordsep)
+            buf = records.pop()
+            for record in records:
+                if cols is None:
+                    cols = record.split(delimiter)
+                else:
+                    yield dict(zip(cols, record.split(delimiter)))
+        proc.wait()
+
+        errfile.seek(0)
+        err = errfile.read()
+        errfile.close()
         if err:
             if show_error:
                 __error("SQL command failed: \nSQL: %s \n%s" % (sql, err), False)
             raise Exception
-        
-        # Convert the delimited output into a dictionary
-        results = [] # list of rows
-        i = 0
-        for line in std.splitlines():
-            if i == 0:
-                cols = [name for name in line.split(delimiter)]
+
+        if buf.endswith('\n'):
+            buf = buf[:-1]
+        if cols is not None and buf:
+            yield dict(zip(cols, buf.split(delimiter)))
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Runs a SQL query on the target platform DB
+# @param sql query text to execute
+# @param show_error displays the SQL error msg
+# @returns the list of result rows (see __iter_sql_query)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_sql_query(sql, show_error):
+
+    return list(__iter_sql_query(sql, show_error))
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Find the path of the preprocessed SQL in the m4 cache dir.
+# The file name is a hash of the m4 arguments (defines), the 
+# source SQL file and the m4 include files it may use.
+# @param m4args m4 command line without the source file
+# @param maddir_madpack m4 include dir
+# @param sqlfile name of the file to parse
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __m4_cache_file(m4args, maddir_madpack, sqlfile):
+
+    h = hashlib.sha1()
+    h.update('\0'.join(m4args))
+    for fname in [sqlfile] + sorted(glob.glob(maddir_madpack + '/*.m4')):
+        f = open(fname, 'rb')
+        try:
+            h.update('\0' + f.read())
+        finally:
+            f.close()
+    return cachedir + '/' + h.hexdigest() + '.sql'
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Preprocess SQL file using m4 (or read it from the m4 cache)
+# @param schema name of the target schema  
+# @param maddir_mod_py name of the module dir with Python code
+# @param module name of the module 
+# @param sqlfile name of the file to parse  
+# @returns the preprocessed SQL text
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __m4_preprocess(schema, maddir_mod_py, module, sqlfile):
+
+    # Find the madpack dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/madpack"):
+        maddir_madpack  = maddir + "/ports/" + portid + "/" + dbver + "/madpack"
+    else:        
+        maddir_madpack  = maddir + "/madpack"
+
+    m4args = [ 'm4', 
+                '-P', 
+                '-DMADLIB_SCHEMA=' + schema, 
+                '-DPLPYTHON_LIBDIR=' + maddir_mod_py, 
+                '-DMODULE_PATHNAME=' + maddir_lib, 
+                '-DMODULE_NAME=' + module, 
+                '-I' + maddir_madpack,
+                '-D' + portid.upper() ]
+
+    # Look up the m4 cache
+    cachefile = None
+    if cachedir:
+        cachefile = __m4_cache_file(m4args, maddir_madpack, sqlfile)
+        if os.path.isfile(cachefile):
+            __info("> ... cached: %s (%s)" % (sqlfile, cachefile), verbose )
+            f = open(cachefile, 'r')
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+    __info("> ... parsing: " + " ".join(m4args + [sqlfile]), verbose )
+
+    proc = subprocess.Popen(m4args + [sqlfile], stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+
+    # Store the output in the cache (via rename, so that concurrent
+    # jobs never read a partially written file)
+    if cachefile and proc.returncode == 0:
+        (fd, cachetmp) = tempfile.mkstemp('.tmp', 'm4.', cachedir)
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+        os.rename(cachetmp, cachefile)
+
+    return output
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Preprocess all SQL files of a module
+# @param schema name of the target schema  
+# @param maddir_mod_py name of the module dir with Python code
+# @param module name of the module 
+# @param sql_files list of files to parse  
+# @returns list of (sqlfile, preprocessed SQL) tuples
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __m4_preprocess_files(schema, maddir_mod_py, module, sql_files):
+
+    parts = []
+    for sqlfile in sql_files:
+        sql = __m4_preprocess(schema, maddir_mod_py, module, sqlfile)
+        sql_hashes[sqlfile] = hashlib.sha1(sql).hexdigest()
+        parts.append((sqlfile, sql))
+    return parts
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write one SQL script made of several preprocessed SQL files
+# @param tmpfile name of the script to write
+# @param parts list of (sqlfile, preprocessed SQL) tuples
+# @param post_sql optional SQL to append to the script
+# @returns list of (first line, sqlfile) tuples mapping the lines
+#          of the script back to the original files
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_sql_script(tmpfile, parts, post_sql):
+
+    offsets = []
+    line = 1
+    f = open(tmpfile, 'w')
+    try:
+        if profile_file:
+            f.write("\\timing\n")
+            line += 1
+        for (sqlfile, sql) in parts:
+            f.write("-- File: %s\n" % sqlfile)
+            offsets.append((line + 1, sqlfile))
+            f.writelines([sql, '\n\n'])
+            line += 1 + sql.count('\n') + 2
+        if post_sql:
+            f.write(post_sql)
+    finally:
+        f.close()
+    return offsets
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Find which file caused the first error reported by psql 
+# when running a script written by __write_sql_script
+# @param logfile name of the log file of the script
+# @param offsets line offsets returned by __write_sql_script
+# @returns description of the error location or None
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __find_script_error(logfile, offsets):
+
+    try:
+        f = open(logfile, 'r')
+        try:
+            log = f.read()
+        finally:
+            f.close()
+    except:
+        return None
+
+    # psql reports errors as "psql:<file>:<line>: ERROR:  <msg>"
+    match = re.search(r'^psql:.*?:(\d+): ERROR:', log, re.M)
+    if not match:
+        return None
+    line = int(match.group(1))
+    for (first, sqlfile) in reversed(offsets):
+        if line >= first:
+            return "%s (line %d after m4 preprocessing)" % (sqlfile, line - first + 1)
+    return None
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Split SQL text into statements. Knows about comments, quoted
+# strings and identifiers (backslash escapes in E'...' strings only),
+# dollar quoting (function bodies) and the data lines following
+# COPY ... FROM stdin, up to \. (skipped).
+# Leading comments are not part of the statements.
+# @param sql SQL text
+# @returns list of (line, statement) tuples, line is 1-based
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __split_sql(sql):
+
+    statements = []
+    start = None
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c.isspace():
+            i += 1
+            continue
+        if sql.startswith('--', i):
+            i = sql.find('\n', i)
+            if i < 0:
+                i = n
+            continue
+        if sql.startswith('/*', i):
+            # Comments nest in PostgreSQL
+            depth = 0
+            while i < n:
+                if sql.startswith('/*', i):
+                    depth += 1
+                    i += 2
+                elif sql.startswith('*/', i):
+                    depth -= 1
+                    i += 2
+                    if depth == 0:
+                        break
+                else:
+                    i += 1
+            continue
+        if start is None:
+            start = i
+        if c == "'" or c == '"':
+            escapes = c == "'" and i > start and sql[i - 1] in 'Ee' \
+                      and (i - 1 == start or not re.match(r'[\w$]', sql[i - 2]))
+            i += 1
+            while i < n:
+                if escapes and sql[i] == '\\':
+                    i += 2
+                elif sql[i] == c:
+                    if sql.startswith(c, i + 1):
+                        i += 2
+                    else:
+                        break
+                else:
+                    i += 1
+            i += 1
+        elif c == '$':
+            match = re.compile(r'\$([A-Za-z_][A-Za-z_0-9]*)?\$').match(sql, i)
+            if match:
+                end = sql.find(match.group(0), match.end())
+                i = n if end < 0 else end + len(match.group(0))
             else:
-                row = {} # dict of col_name:col_value pairs
-                c = 0
-                for val in line.split(delimiter):
-                    row[cols[c]] = val
-                    c += 1
-                results.insert(i,row)
+                i += 1
+        elif c == ';':
+            statement = sql[start:i + 1]
+            statements.append((sql.count('\n', 0, start) + 1, statement))
+            start = None
             i += 1
-        # Drop the last line: "(X rows)"
-        try:
-            results.pop()
-        except:
-            pass
-    
-    return results
+            # The data of COPY FROM stdin starts on the next line
+            if re.match(r'COPY\b.*\bFROM\s+STDIN\b', statement, re.I | re.S):
+                match = re.compile(r'^\\\.[ \t\r]*$', re.M).search(sql, i)
+                i = n if match is None else match.end()
+        else:
+            i += 1
+    if start is not None:
+        statements.append((sql.count('\n', 0, start) + 1, sql[start:]))
+    return statements
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Run SQL file
@@ -175,35 +578,133 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre
     try:
         f = open(tmpfile, 'w')
         
+        # Report the time of every statement in the log
+        if profile_file:
+            f.write("\\timing\n")
+
         # Add the before SQL
         if pre_sql:
             f.writelines([pre_sql, '\n\n'])
-            f.flush()
         
-        # Find the madpack dir (platform specific or generic)
-        if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/madpack"):
-            maddir_madpack  = maddir + "/ports/" + portid + "/" + dbver + "/madpack"
-        else:        
-            maddir_madpack  = maddir + "/madpack"
-
-        m4args = [ 'm4', 
-                    '-P', 
-                    '-DMADLIB_SCHEMA=' + schema, 
-                    '-DPLPYTHON_LIBDIR=' + maddir_mod_py, 
-                    '-DMODULE_PATHNAME=' + maddir_lib, 
-                    '-DMODULE_NAME=' + module, 
-                    '-I' + maddir_madpack,
-                    '-D' + portid.upper(), 
-                    sqlfile ]
-
-        __info("> ... parsing: " + " ".join(m4args), verbose )
-                    
-        subprocess.call(m4args, stdout=f)  
+        sql = __m4_preprocess(schema, maddir_mod_py, module, sqlfile)
+        f.write(sql)
         f.close()         
     except:
         __error("Failed executing m4 on %s" % sqlfile, False)
         raise Exception
 
+    # Remember what has been run (see __db_record_hashes)
+    sql_hashes[sqlfile] = hashlib.sha1(sql).hexdigest()
+
+    run_start = time.time()
+    retval = __run_sql_script(tmpfile, logfile, False)
+    sql_times[sqlfile] = int((time.time() - run_start) * 1000)
+    if profile_file:
+        __profile_log(logfile, [(sqlfile, sql)], pre_sql)
+    return retval
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Collect the statement timings printed by psql (\timing) in
+# the log of a script. The "Time: N ms" lines are matched in 
+# order with the statements of the script (see __split_sql).
+# @param logfile name of the log file of the script
+# @param parts list of (sqlfile, preprocessed SQL) tuples
+# @param pre_sql optional SQL run before the files
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __profile_log(logfile, parts, pre_sql):
+
+    try:
+        f = open(logfile, 'r')
+        try:
+            times = re.findall(r'^Time: ([0-9.]+) ms', f.read(), re.M)
+        finally:
+            f.close()
+    except:
+        return
+
+    # Skip the timings of the before SQL
+    if pre_sql:
+        times = times[len(__split_sql(pre_sql)):]
+
+    for (sqlfile, sql) in parts:
+        # Module of the file: .../<module>/file.sql_in or .../<module>/test/file.sql_in
+        path = os.path.dirname(sqlfile)
+        if os.path.basename(path) == 'test':
+            path = os.path.dirname(path)
+        for (line, stmt) in __split_sql(sql):
+            if not times:
+                return
+            profile.append({ 'module': os.path.basename(path)
+                           , 'file': os.path.basename(sqlfile)
+                           , 'line': line
+                           , 'statement': ' '.join(stmt.split())[:200]
+                           , 'milliseconds': float(times.pop(0))
+                           })
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write the statement timings collected in profiling mode to
+# profile_file (JSON) and print the slowest statements
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_profile():
+
+    if not profile_file:
+        return
+
+    # Per-file totals
+    files = {}
+    for p in profile:
+        key = (p['module'], p['file'])
+        if key not in files:
+            files[key] = { 'module': p['module'], 'file': p['file']
+                         , 'statements': 0, 'milliseconds': 0.0 }
+        files[key]['statements'] += 1
+        files[key]['milliseconds'] += p['milliseconds']
+
+    slowest = sorted(profile, key=lambda p: p['milliseconds'], reverse=True)[:20]
+    try:
+        import json
+        f = open(profile_file, 'w')
+        try:
+            json.dump({ 'version': rev
+                      , 'platform': portid
+                      , 'dbversion': dbver
+                      , 'files': sorted(files.values(), 
+                                        key=lambda r: r['milliseconds'], reverse=True)
+                      , 'statements': profile
+                      , 'slowest': slowest
+                      }, f, indent=2)
+        finally:
+            f.close()
+    except:
+        __error("Cannot write profile file: %s" % profile_file, False)
+        return
+
+    __info("Slowest statements:", True)
+    for p in slowest[:10]:
+        __info("> %10.1f ms  %s/%s:%d  %s" % (p['milliseconds'], p['module'], p['file'],
+                                             p['line'], p['statement'][:60]), True)
+    __info("Profile written to %s" % profile_file, True)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Record the execution time of a script made of several 
+# files, split between the files by their size (estimate)
+# @param parts list of (sqlfile, preprocessed SQL) tuples
+# @param milliseconds execution time of the whole script
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __record_script_time(parts, milliseconds):
+
+    total = sum(len(sql) for (sqlfile, sql) in parts) or 1
+    for (sqlfile, sql) in parts:
+        sql_times[sqlfile] = int(milliseconds * len(sql) / total)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Run a preprocessed SQL script using DB command-line utility
+# @param tmpfile name of the file to run
+# @param logfile name of the log file (stdout)    
+# @param single_transaction run the whole file in one transaction
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_sql_script(tmpfile, logfile, single_transaction):
+
     # Run the SQL using DB command-line utility
     if portid == 'greenplum' or portid == 'postgres':
 
@@ -211,9 +712,7 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre
         sqlcmd = 'psql'
         
         # Test the DB cmd line utility
-        std, err = subprocess.Popen(['which', sqlcmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if std == '':
-            __error("Command not found: %s" % sqlcmd, True)
+        __check_sqlcmd(sqlcmd)
                             
         runcmd = [ sqlcmd, '-a',
                     '-v', 'ON_ERROR_STOP=1',
@@ -222,6 +721,11 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre
                     '-d', con_args['database'],
                     '-U', con_args['user'],
                     '-f', tmpfile]
+        if single_transaction:
+            runcmd.insert(1, '--single-transaction')
+        if profile_file:
+            # Do not let ~/.psqlrc toggle \timing
+            runcmd.insert(1, '-X')
         runenv = os.environ
         runenv["PGPASSWORD"] = con_args['password']
         
@@ -244,6 +748,53 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre
 
     return retval
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Read the database properties madpack needs in one query:
+# server version, PL/Python presence, status of the MADlib 
+# schema and of its MigrationHistory table. The result is 
+# cached for the rest of the run (see __clear_dbinfo).
+# @param schema MADlib schema name
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __get_dbinfo(schema):
+
+    global dbinfo
+    if dbinfo is None or dbinfo['schema'] != schema:
+        row = __run_sql_query("""
+            SELECT 
+                version() AS version,
+                (SELECT count(*) FROM pg_language 
+                  WHERE lanname = 'plpythonu') AS plpythonu,
+                (SELECT count(*) FROM pg_namespace 
+                  WHERE nspname = '%(schema)s') AS schema_exists,
+                (SELECT count(*) FROM pg_namespace 
+                  WHERE nspname = '%(schema)s' 
+                    AND has_schema_privilege(oid, 'CREATE')) AS schema_writable,
+                (SELECT count(*) FROM pg_tables 
+                  WHERE schemaname = '%(schema)s' 
+                    AND tablename = 'migrationhistory') AS migrationhistory,
+                (SELECT count(*) FROM pg_tables 
+                  WHERE schemaname = '%(schema)s' 
+                    AND tablename = 'migrationhistory_files') AS migrationhistory_files
+            """ % {'schema': schema}, True)[0]
+        dbinfo = { 'schema': schema
+                 , 'version': row['version']
+                 , 'plpythonu': int(row['plpythonu']) > 0
+                 , 'schema_exists': int(row['schema_exists']) > 0
+                 , 'schema_writable': int(row['schema_writable']) > 0
+                 , 'migrationhistory': int(row['migrationhistory']) > 0
+                 , 'migrationhistory_files': int(row['migrationhistory_files']) > 0
+                 }
+    return dbinfo
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Forget the database properties read by __get_dbinfo
+# (after changing the MADlib schema or the languages)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __clear_dbinfo():
+
+    global dbinfo
+    dbinfo = None
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Read MADlib version from database
 # @param dbconn database conection object
@@ -251,9 +802,7 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 def __get_madlib_dbver(schema):
     try:
-        row = __run_sql_query("""SELECT count(*) AS cnt FROM pg_tables 
-            WHERE schemaname='%s' AND tablename='migrationhistory'""" % (schema), True)
-        if int(row[0]['cnt']) > 0:
+        if __get_dbinfo(schema)['migrationhistory']:
             row = __run_sql_query("""SELECT version FROM %s.migrationhistory 
                 ORDER BY applied DESC LIMIT 1""" % schema, True)
             if row:
@@ -266,10 +815,9 @@ def __get_madlib_dbver(schema):
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Read version number from database (of form X.Y)
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def __get_dbver():
+def __get_dbver(schema):
     try:
-        versionString = __run_sql_query("""SELECT version()""",
-            True)[0]['version']
+        versionString = __get_dbinfo(schema)['version']
         if portid == 'postgres':
             return re.search("PostgreSQL[a-zA-Z\s]*(\d+\.\d+)",
                 versionString).group(1)
@@ -282,24 +830,21 @@ def __get_dbver():
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Make sure we are connected to the expected DB platform
 # @param portid expected DB port id - to be validates
+# @param schema MADlib schema name
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def __check_db_port(portid):
+def __check_db_port(portid, schema):
+    try:
+        version = __get_dbinfo(schema)['version'].lower()
+    except:
+        __error("Cannot validate DB platform type", True)
     # Postgres
     if portid == 'postgres':
-        try:
-            row = __run_sql_query("SELECT version() AS version", True)  
-        except:
-            __error("Cannot validate DB platform type", True)
-        if (row[0]['version'].lower().find(portid) >= 0 and 
-            row[0]['version'].lower().find('greenplum') < 0):
+        if (version.find(portid) >= 0 and 
+            version.find('greenplum') < 0):
             return True
     # Greenplum
     if portid == 'greenplum':
-        try:
-            row = __run_sql_query("SELECT version() AS version", True)  
-        except:
-            __error("Cannot validate DB platform type", True)
-        if row[0]['version'].lower().find(portid) >= 0:
+        if version.find(portid) >= 0:
             return True            
     return False
                 
@@ -339,14 +884,14 @@ def __print_revs(rev, dbrev, con_args, schema):
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Check pl/python existence and version
 # @param py_min_ver min Python version to run MADlib 
+# @param schema MADlib schema name
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def __plpy_check(py_min_ver):
+def __plpy_check(py_min_ver, schema):
 
     __info("Testing PL/Python environment...", True)
 
     # Check PL/Python existence
-    rv = __run_sql_query("SELECT count(*) AS CNT FROM pg_language WHERE lanname = 'plpythonu'", True)
-    if int(rv[0]['cnt']) > 0:
+    if __get_dbinfo(schema)['plpythonu']:
         __info("> PL/Python already installed", verbose)            
     else:
         __info("> PL/Python not installed", verbose)            
@@ -356,10 +901,11 @@ def __plpy_check(py_min_ver):
         except:
             __error('Cannot create language plpythonu. Stopping installation...', False)
             raise Exception                
+        __clear_dbinfo()
 
-    # Check PL/Python version
-    __run_sql_query("DROP FUNCTION IF EXISTS plpy_version_for_madlib();", False)
-    __run_sql_query("""
+    # Check PL/Python version (in a single round trip)
+    rv = __run_sql_query("""
+        DROP FUNCTION IF EXISTS plpy_version_for_madlib();
         CREATE OR REPLACE FUNCTION plpy_version_for_madlib() 
         RETURNS TEXT AS 
         $$
@@ -368,8 +914,8 @@ def __plpy_check(py_min_ver):
             return str(sys.version_info[:3]).replace(',','.').replace(' ','').replace(')','').replace('(','')
         $$
         LANGUAGE plpythonu;
+        SELECT plpy_version_for_madlib() AS ver;
     """, True)
-    rv = __run_sql_query("SELECT plpy_version_for_madlib() AS ver;", True)
     python = rv[0]['ver']
     py_cur_ver = [int(i) for i in python.split('.')]
     if py_cur_ver >= py_min_ver:
@@ -382,6 +928,26 @@ def __plpy_check(py_min_ver):
 
     __info("> PL/Python environment OK (version: %s)" % python, True)            
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Ask the user to continue (Y/N). Answers Y with -y/--yes, and N 
+# when there is no input to read (e.g. stdin is /dev/null).
+# @returns 'Y' or 'N'
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __confirm():
+
+    __info("Would you like to continue? [Y/N]", True)
+    if assume_yes:
+        __info(">>> Y (-y/--yes)", True)
+        return 'Y'
+    try:
+        go = raw_input('>>> ').upper()
+        while go != 'Y' and go != 'N':
+            go = raw_input('Yes or No >>> ').upper()
+    except EOFError:
+        __info("> No answer (use -y/--yes to run without prompts)", True)
+        go = 'N'
+    return go
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Install MADlib
 # @param schema MADlib schema name
@@ -403,9 +969,8 @@ def __db_install(schema, dbrev):
 
     # Test if schema is writable
     try:
-        __run_sql_query("CREATE TABLE %s.__madlib_test_table (A INT);" % schema, False)
-        __run_sql_query("DROP TABLE %s.__madlib_test_table;" % schema, False)
-        schema_writable = True
+        info = __get_dbinfo(schema)
+        schema_writable = info['schema_exists'] and info['schema_writable']
     except:
         schema_writable = False
         
@@ -422,10 +987,7 @@ def __db_install(schema, dbrev):
         __info("* Schema %s already exists" % schema.upper(), True)
         __info("* Installer will rename it to %s" % temp_schema.upper(), True)
         __info("***************************************************************************", True)
-        __info("Would you like to continue? [Y/N]", True)
-        go = raw_input('>>> ').upper()
-        while go != 'Y' and go != 'N':
-            go = raw_input('Yes or No >>> ').upper()
+        go = __confirm()
         if go == 'N':            
             __info('Installation stopped.', True)
             return
@@ -480,6 +1042,106 @@ def __db_install(schema, dbrev):
 
     __info("MADlib %s installed successfully in %s schema." % (rev, schema.upper()), True)
         
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Print the installation plan: for every module the number of 
+# files, statements and bytes of preprocessed SQL, the objects 
+# that would be created and the execution time recorded by the
+# last installation (if any). For an update, only the modules the
+# incremental update would re-run are listed. Nothing is executed.
+# @param schema MADlib schema name
+# @param command install, update or reinstall
+# @param dbrev DB-level MADlib version
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_plan(schema, command, dbrev):
+
+    # Modules an update would re-run (None: all of them)
+    update_modules = None
+    module_sql = {}
+    if command == 'update':
+        if __get_rev_num(dbrev) >= __get_rev_num(rev):
+            __info("Current MADlib version already up to date, nothing to update.", True)
+            return
+        if dbrev != None and __get_dbinfo(schema)['migrationhistory_files']:
+            (modules, module_sql, module_objects) = __db_update_modules(schema)
+            blocker = __db_update_blocker(modules, module_objects)
+            if blocker:
+                __info("> %s, update runs a full installation" % blocker, True)
+            else:
+                update_modules = modules
+        else:
+            __info("> No file hashes found in schema %s, update runs a full installation" 
+                    % schema.upper(), True)
+
+    # Execution times of the last installation
+    history = {}
+    if __get_dbinfo(schema)['migrationhistory_files']:
+        try:
+            for row in __iter_sql_query("""SELECT module, sum(milliseconds) AS ms 
+                    FROM %s.migrationhistory_files GROUP BY module""" % schema, False):
+                if row['ms'] is not None and row['ms'] != '':
+                    history[row['module']] = int(row['ms'])
+        except:
+            pass
+
+    object_re = re.compile(r'CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP(?:ORARY)?\s+)?'
+                           r'(FUNCTION|AGGREGATE|TYPE|TABLE|VIEW|OPERATOR\s+CLASS|'
+                           r'OPERATOR|CAST|INDEX|SEQUENCE)\s+([^\s(]+)', re.I)
+
+    if update_modules is None:
+        __info("Installation plan for %s schema:" % schema.upper(), True)
+    elif update_modules:
+        __info("Update plan for %s schema (modules with changed SQL and the modules "
+               "depending on them; their objects are dropped first):" % schema.upper(), True)
+    else:
+        __info("Update plan for %s schema: no module SQL changed, only the version "
+               "is recorded." % schema.upper(), True)
+        return
+    print "%-20s | %5s | %10s | %9s | %9s | %s" \
+          % ("Module", "Level", "Statements", "Bytes", "Last time", "Objects")
+    print "-" * 21 + "+" + "-" * 7 + "+" + "-" * 12 + "+" + "-" * 11 + "+" + "-" * 11 + "+" + "-" * 30
+    totals = [0, 0, 0]
+    for moduleinfo in portspecs['modules']:
+        module = moduleinfo['name']
+        if update_modules is not None and module not in update_modules:
+            continue
+        (maddir_mod_py, sql_files) = __get_module_files(module)
+        if sql_files is None:
+            continue
+
+        statements = 0
+        size = 0
+        objects = {}
+        names = []
+        parts = module_sql.get(module)
+        if parts is None:
+            parts = __m4_preprocess_files(schema, maddir_mod_py, module, sql_files)
+        for (sqlfile, sql) in parts:
+            size += len(sql)
+            for (line, stmt) in __split_sql(sql):
+                statements += 1
+                match = object_re.match(stmt)
+                if match:
+                    kind = ' '.join(match.group(1).upper().split())
+                    objects[kind] = objects.get(kind, 0) + 1
+                    names.append("%s %s" % (kind, match.group(2)))
+
+        if module in history:
+            last = "%.1fs" % (history[module] / 1000.0)
+            totals[2] += history[module]
+        else:
+            last = "-"
+        totals[0] += statements
+        totals[1] += size
+        print "%-20s | %5d | %10d | %9d | %9s | %s" \
+              % (module, moduleinfo['level'], statements, size, last,
+                 ", ".join("%d %s" % (objects[k], k) for k in sorted(objects.keys())))
+        for name in names:
+            __info(">   %s: %s" % (module, name), verbose)
+
+    print "%-20s | %5s | %10d | %9d | %9s |" \
+          % ("TOTAL", "", totals[0], totals[1], 
+             "%.1fs" % (totals[2] / 1000.0) if history else "-")
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Rename schema
 # @param from_schema name of the schema to rename
@@ -490,6 +1152,7 @@ def __db_rename_schema(from_schema, to_schema):
     __info("> Renaming schema %s to %s" % (from_schema.upper(), to_schema.upper()), True)        
     try:
         __run_sql_query("ALTER SCHEMA %s RENAME TO %s;" % (from_schema, to_schema), True)
+        __clear_dbinfo()
     except:
         __error('Cannot rename schema. Stopping installation...', False)
         raise Exception
@@ -504,6 +1167,7 @@ def __db_create_schema(schema):
     __info("> Creating %s schema" % schema.upper(), True)        
     try:
         __run_sql_query("CREATE SCHEMA %s;" % schema, True)
+        __clear_dbinfo()
     except:
         __info('Cannot create new schema. Rolling back installation...', True)
         pass
@@ -521,6 +1185,11 @@ def __db_create_objects(schema, old_schema):
         sql = """CREATE TABLE %s.migrationhistory 
                (id serial, version varchar(255), applied timestamp default current_timestamp);""" % schema
         __run_sql_query(sql, True);
+        __run_sql_query("DROP TABLE IF EXISTS %s.migrationhistory_files;" % schema, True)
+        sql = """CREATE TABLE %s.migrationhistory_files 
+               (module varchar(255), sqlfile varchar(255), hash char(40), 
+                milliseconds int, applied timestamp default current_timestamp);""" % schema
+        __run_sql_query(sql, True);
     except:
         __error("Cannot crate MigrationHistory table", False)
         raise Exception
@@ -548,59 +1217,587 @@ def __db_create_objects(schema, old_schema):
     # Run migration SQLs    
     __info("> Creating objects for modules:", True)  
     
-    # Loop through all modules/modules  
-    for moduleinfo in portspecs['modules']:   
-     
-        # Get the module name
+    # Group modules by dependency level. Modules in the same level
+    # do not depend on each other, so with --jobs > 1 they are
+    # created concurrently (each psql run uses its own connection)
+    levels = []
+    for moduleinfo in portspecs['modules']:
+        if not levels or levels[-1][0] != moduleinfo['level']:
+            levels.append((moduleinfo['level'], []))
+        levels[-1][1].append(moduleinfo['name'])
+
+    # Loop through all levels, waiting for each one to finish
+    for (level, modules) in levels:
+        failed = __run_parallel(lambda module: __db_create_module(schema, module),
+                                modules, jobs)
+        if failed:
+            __error("Failed creating objects for modules: %s" % ", ".join(failed), False)
+            raise Exception
+
+    # Record what has been installed (for incremental updates)
+    __db_record_hashes(schema, [m['name'] for m in portspecs['modules']])
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Get the SQL statements recording the hashes of the preprocessed
+# SQL files of the given modules in the MigrationHistory_Files table
+# @param schema name of the target schema 
+# @param modules list of module names
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_hashes_sql(schema, modules):
+
+    rows = []
+    for module in modules:
+        (maddir_mod_py, sql_files) = __get_module_files(module)
+        for sqlfile in (sql_files or []):
+            rows.append("('%s', '%s', '%s', %s)" 
+                        % (module, os.path.basename(sqlfile), sql_hashes[sqlfile],
+                           sql_times.get(sqlfile, 'NULL')))
+
+    sql = "DELETE FROM %s.migrationhistory_files WHERE module IN ('%s');\n" \
+          % (schema, "', '".join(modules))
+    if rows:
+        sql += "INSERT INTO %s.migrationhistory_files (module, sqlfile, hash, milliseconds) VALUES\n    %s;\n" \
+               % (schema, ",\n    ".join(rows))
+    return sql
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Record the hashes of the installed SQL files
+# @param schema name of the target schema 
+# @param modules list of module names
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_record_hashes(schema, modules):
+
+    __info("> Writing file hashes in MigrationHistory_Files table", verbose)
+    try:
+        __run_sql_query(__db_hashes_sql(schema, modules), True)
+    except:
+        __error("Cannot insert data into %s.migrationhistory_files table" % schema, False)
+        raise Exception
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# List the objects created in the MADlib schema by preprocessed
+# SQL (temporary tables and objects of other schemas are left out)
+# @param schema MADlib schema name
+# @param parts list of (sqlfile, sql) tuples
+# @returns list of (kind, name) tuples in creation order, e.g.
+#          ('AGGREGATE', 'kmeans_canopy'); name is None for casts,
+#          operators are listed whatever their schema
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __sql_objects(schema, parts):
+
+    create_re = re.compile(r'CREATE\s+(?:OR\s+REPLACE\s+)?(TEMP(?:ORARY)?\s+)?'
+                           r'(FUNCTION|AGGREGATE|TYPE|TABLE|VIEW|SEQUENCE|'
+                           r'OPERATOR\s+CLASS|OPERATOR|CAST)\b\s*([^\s(]*)', re.I)
+    prefix = schema.lower() + '.'
+    objects = []
+    for (sqlfile, sql) in parts:
+        for (line, stmt) in __split_sql(sql):
+            match = create_re.match(stmt)
+            if not match or match.group(1):
+                continue
+            kind = ' '.join(match.group(2).upper().split())
+            name = match.group(3).lower()
+            if kind in ('CAST', 'OPERATOR', 'OPERATOR CLASS'):
+                # Only recorded to refuse in-place updates
+                objects.append((kind, kind != 'CAST' and name or None))
+            elif name.startswith(prefix):
+                objects.append((kind, name[len(prefix):]))
+    return objects
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Build the SQL dropping the objects created by the given modules
+# (in reverse order of creation, modules in reverse dependency 
+# order) so that their SQL can run again. Objects are dropped 
+# without CASCADE: if objects of other modules (or of users) depend 
+# on them the script fails instead of silently dropping those.
+# Functions and aggregates are dropped with all their signatures 
+# found in the catalog.
+# @param schema MADlib schema name
+# @param modules list of module names (in dependency order)
+# @param module_objects dictionary module -> list of (kind, name)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_drop_objects_sql(schema, modules, module_objects):
+
+    # Signatures of the functions and aggregates
+    procs = set()
+    for module in modules:
+        for (kind, name) in module_objects[module]:
+            if kind in ('FUNCTION', 'AGGREGATE'):
+                procs.add(name)
+    signatures = {}
+    types = {}
+    if procs:
+        argtypes = set()
+        for row in __iter_sql_query("""SELECT p.proname, p.proargtypes,
+                    EXISTS (SELECT 1 FROM pg_aggregate a WHERE a.aggfnoid = p.oid) AS isagg
+                FROM pg_proc p, pg_namespace n 
+                WHERE p.pronamespace = n.oid AND n.nspname = '%s' 
+                    AND p.proname IN ('%s')""" 
+                % (schema, "', '".join(sorted(procs))), True):
+            args = row['proargtypes']
+            if isinstance(args, basestring):
+                args = args.split()
+            args = [str(a) for a in args]
+            argtypes.update(args)
+            signatures.setdefault(row['proname'], []).append(
+                (row['isagg'] in (True, 't'), args))
+        if argtypes:
+            for row in __iter_sql_query("""SELECT t.oid, n.nspname, t.typname
+                    FROM pg_type t, pg_namespace n 
+                    WHERE t.typnamespace = n.oid AND t.oid IN (%s)""" 
+                    % ", ".join(sorted(argtypes)), True):
+                types[str(row['oid'])] = '"%s"."%s"' % (row['nspname'], row['typname'])
+
+    sql = []
+    done = set()
+    for module in reversed(modules):
+        for (kind, name) in reversed(module_objects[module]):
+            if kind in ('FUNCTION', 'AGGREGATE'):
+                for (isagg, args) in signatures.pop(name, []):
+                    argsql = ", ".join([types[a] for a in args])
+                    if isagg:
+                        sql.append("DROP AGGREGATE %s.%s(%s);" % (schema, name, argsql or '*'))
+                    else:
+                        sql.append("DROP FUNCTION %s.%s(%s);" % (schema, name, argsql))
+            elif (kind, name) not in done:
+                done.add((kind, name))
+                sql.append("DROP %s IF EXISTS %s.%s;" % (kind, schema, name))
+    return "\n".join(sql) + "\n"
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Find the modules an incremental update re-runs: the modules 
+# whose preprocessed SQL changed since the last installation, plus
+# all modules depending on them (or creating objects of the same 
+# name). Used by __db_update and by the update plan.
+# @param schema MADlib schema name
+# @returns a tuple (modules, module_sql, module_objects): the modules
+#          to update (in dependency order), and the preprocessed SQL
+#          parts and the objects (see __sql_objects) of every module
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_update_modules(schema):
+
+    # Read the hashes recorded at installation time
+    try:
+        rows = __run_sql_query("SELECT module, sqlfile, hash FROM %s.migrationhistory_files" 
+                               % schema, True)
+    except:
+        __error("Cannot read %s.migrationhistory_files table" % schema, False)
+        raise Exception
+    installed = {}
+    for row in rows:
+        installed.setdefault(row['module'], {})[row['sqlfile']] = row['hash'].strip()
+
+    # Find the modules with changed SQL
+    changed = set()
+    module_sql = {}
+    for moduleinfo in portspecs['modules']:
         module = moduleinfo['name']
-        __info("> - %s" % module, True)        
-        
-        # Find the Python module dir (platform specific or generic)
-        if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
-            maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
-        else:
-            maddir_mod_py  = maddir + "/modules"
-        
-        # Find the SQL module dir (platform specific or generic)
-        if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
-            maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
-        elif os.path.isdir(maddir + "/modules/" + module):
-            maddir_mod_sql  = maddir + "/modules"
-        else:
-            # This was a platform-specific module, for which no default exists.
-            # We can just skip this module.
+        (maddir_mod_py, sql_files) = __get_module_files(module)
+        if sql_files is None:
             continue
+        module_sql[module] = __m4_preprocess_files(schema, maddir_mod_py, module, sql_files)
+        current = {}
+        for sqlfile in sql_files:
+            current[os.path.basename(sqlfile)] = sql_hashes[sqlfile]
+        if current != installed.get(module):
+            changed.add(module)
+
+    # Objects created by each module: they are dropped before the SQL 
+    # of the module runs again
+    module_objects = {}
+    for module in module_sql:
+        module_objects[module] = __sql_objects(schema, module_sql[module])
+
+    # Add all modules depending on them, and the modules creating
+    # objects of the same name (e.g. overloaded functions, whose 
+    # signatures would be dropped too)
+    found = True
+    while found:
+        found = False
+        names = set([name for module in changed 
+                          for (kind, name) in module_objects[module]])
+        for moduleinfo in portspecs['modules']:
+            module = moduleinfo['name']
+            if module in changed or module not in module_sql:
+                continue
+            if (changed.intersection(moduleinfo.get('depends') or [])
+                    or names.intersection([name for (kind, name) in module_objects[module]])):
+                changed.add(module)
+                found = True
 
-        # Make a temp dir for log files 
-        cur_tmpdir = tmpdir + "/" + module
-        __make_dir(cur_tmpdir)
+    modules = [m['name'] for m in portspecs['modules'] if m['name'] in changed]
+    return (modules, module_sql, module_objects)
 
-        # Loop through all SQL files for this module
-        mask = maddir_mod_sql + '/' + module + '/*.sql_in'
-        sql_files = glob.glob(mask)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Check whether modules can be updated in place: objects such as
+# operators, operator classes and casts cannot be dropped by name
+# @param modules list of module names
+# @param module_objects dictionary module -> list of (kind, name)
+# @returns the reason why they cannot, or None
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_update_blocker(modules, module_objects):
+
+    for module in modules:
+        kinds = set([kind for (kind, name) in module_objects[module]]) \
+                & set(['OPERATOR', 'OPERATOR CLASS', 'CAST'])
+        if kinds:
+            return "Module %s creates objects that cannot be updated in place (%s)" \
+                   % (module, ", ".join(sorted(kinds)))
+    return None
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Update MADlib incrementally: re-run only the SQL of the modules
+# whose preprocessed SQL changed since the last installation, 
+# plus all modules depending on them (or creating objects of the
+# same name). Their objects are dropped first, in the same 
+# transaction. Falls back to a full installation if no file hashes
+# are recorded, a module creates objects that cannot be dropped 
+# automatically (operators, operator classes, casts) or the update
+# fails.
+# @param schema MADlib schema name
+# @param dbrev DB-level MADlib version
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_update(schema, dbrev):
 
-        if not sql_files:
-            __error("No files found in: %s" % mask, True)
+    # Without the hashes recorded at installation time we cannot tell
+    # what changed
+    try:
+        if dbrev == None or not __get_dbinfo(schema)['migrationhistory_files']:
+            __info("> No file hashes found in schema %s, running full installation" 
+                    % schema.upper(), True)
+            return __db_install(schema, dbrev)
+    except:
+        __error("Cannot read %s.migrationhistory_files table" % schema, False)
+        raise Exception
 
-        # Execute all SQL files for the module
-        for sqlfile in sql_files:
+    __info("Updating MADlib in %s schema..." % schema.upper(), True)
+    (modules, module_sql, module_objects) = __db_update_modules(schema)
+    if modules:
+        __info("> Modules to update: %s" % ", ".join(modules), True)
+    else:
+        __info("> No module SQL changed", True)
+
+    # Objects we cannot drop by name
+    blocker = __db_update_blocker(modules, module_objects)
+    if blocker:
+        __info("> %s, running full installation" % blocker, True)
+        return __db_install(schema, dbrev)
+
+    try:
+        drop_sql = __db_drop_objects_sql(schema, modules, module_objects)
+    except:
+        __error("Cannot read the objects of schema %s" % schema, False)
+        raise Exception
+
+    # Build a single script (in dependency order) and run it as one 
+    # transaction, so a failure leaves the schema untouched
+    cur_tmpdir = tmpdir + "/update"
+    __make_dir(cur_tmpdir)
+    tmpfile = cur_tmpdir + '/update.sql.tmp'
+    logfile = cur_tmpdir + '/update.sql.log'
+    try:
+        parts = []
+        if modules:
+            parts.append(("objects of the updated modules (DROP)", drop_sql))
+        for module in modules:
+            parts.extend(module_sql[module])
+        offsets = __write_sql_script(tmpfile, parts, 
+            __db_hashes_sql(schema, modules) +
+            "INSERT INTO %s.migrationhistory(version) VALUES('%s');\n" % (schema, rev))
+    except:
+        __error("Cannot create update script: %s" % tmpfile, False)
+        raise Exception
+
+    run_start = time.time()
+    retval = __run_sql_script(tmpfile, logfile, True)
+    if profile_file:
+        __profile_log(logfile, parts, None)
+    if retval != 0:
+        source = __find_script_error(logfile, offsets)
+        if source:
+            __error("Error in %s" % source, False)
+        __error("Incremental update failed. Check the log at %s" % logfile, False)
+        __info("> Falling back to full installation", True)
+        return __db_install(schema, dbrev)
+
+    # Record the execution times (estimated per file)
+    __record_script_time(parts, int((time.time() - run_start) * 1000))
+    updates = ["UPDATE %s.migrationhistory_files SET milliseconds = %d " 
+               "WHERE module = '%s' AND sqlfile = '%s';" 
+               % (schema, sql_times[sqlfile], module, os.path.basename(sqlfile))
+               for module in modules for (sqlfile, sql) in module_sql[module]]
+    if updates:
+        try:
+            __run_sql_query("\n".join(updates), False)
+        except:
+            __info("> Cannot record execution times in %s.migrationhistory_files" 
+                    % schema, verbose)
+
+    __info("MADlib %s updated successfully in %s schema." % (rev, schema.upper()), True)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Find the Python module dir and the SQL files of a module
+# @param module name of the module 
+# @returns a tuple (maddir_mod_py, sql_files); sql_files is None 
+#          for a platform-specific module missing on this port
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __get_module_files(module):
+
+    # Find the Python module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
+        maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
+    else:
+        maddir_mod_py  = maddir + "/modules"
+    
+    # Find the SQL module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
+    elif os.path.isdir(maddir + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/modules"
+    else:
+        return (maddir_mod_py, None)
+
+    # Find all SQL files for this module
+    mask = maddir_mod_sql + '/' + module + '/*.sql_in'
+    sql_files = sorted(glob.glob(mask))
+
+    if not sql_files:
+        __error("No files found in: %s" % mask, True)
+
+    return (maddir_mod_py, sql_files)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Create MADlib DB objects of a single module
+# @param schema name of the target schema 
+# @param module name of the module 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_create_module(schema, module):
+
+    __info("> - %s" % module, True)        
+    
+    (maddir_mod_py, sql_files) = __get_module_files(module)
+    if sql_files is None:
+        # This was a platform-specific module, for which no default exists.
+        # We can just skip this module.
+        return
+
+    # Make a temp dir for log files 
+    cur_tmpdir = tmpdir + "/" + module
+    __make_dir(cur_tmpdir)
+
+    # Execute all SQL files for the module as one script 
+    # in a single transaction
+    if module_transaction:
 
-            # Set file names
-            tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
-            logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
+        # Set file names
+        tmpfile = cur_tmpdir + '/' + module + '.sql.tmp'
+        logfile = cur_tmpdir + '/' + module + '.sql.log'
+
+        try:
+            parts = __m4_preprocess_files(schema, maddir_mod_py, module, sql_files)
+            offsets = __write_sql_script(tmpfile, parts, None)
+        except:
+            __error("Failed preparing %s" % tmpfile, False)
+            raise Exception
+
+        # Run the SQL and check the exit status
+        run_start = time.time()
+        retval = __run_sql_script(tmpfile, logfile, True)
+        __record_script_time(parts, int((time.time() - run_start) * 1000))
+        if profile_file:
+            __profile_log(logfile, parts, None)
+        if retval != 0:
+            __error("Failed executing %s" % tmpfile, False)  
+            source = __find_script_error(logfile, offsets)
+            if source:
+                __error("Error in %s" % source, False)
+            __error("Check the log at %s" % logfile, False) 
+            raise Exception    
+        return
+
+    # Execute all SQL files for the module
+    for sqlfile in sql_files:
+
+        # Set file names
+        tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
+        logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
+        
+        # Run the SQL
+        try:
+            retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, None)
+        except:
+            raise Exception
             
-            # Run the SQL
-            try:
-                retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, None)
-            except:
-                raise Exception
-                
-            # Check the exit status
-            if retval != 0:
-                __error("Failed executing %s" % tmpfile, False)  
-                __error("Check the log at %s" % logfile, False) 
-                raise Exception    
+        # Check the exit status
+        if retval != 0:
+            __error("Failed executing %s" % tmpfile, False)  
+            __error("Check the log at %s" % logfile, False) 
+            raise Exception    
                        
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Run the install-check test scripts of a module
+# @param schema MADlib schema name
+# @param test_user database user running the tests
+# @param module name of the module 
+# @returns list of test results, one dict per test file
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_install_check_module(schema, test_user, module):
+
+    global keeplogs
+    results = []
+
+    __info("> - %s" % module, verbose)        
+
+    # Make a temp dir for this module (if doesn't exist)
+    cur_tmpdir = tmpdir + '/' + module + '/test'
+    __make_dir(cur_tmpdir)
+    
+    # Find the Python module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
+        maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
+    else:        
+        maddir_mod_py  = maddir + "/modules"
+    
+    # Find the SQL module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
+    else:        
+        maddir_mod_sql  = maddir + "/modules"
+
+    # Prepare test schema
+    test_schema = "madlib_installcheck_%s" % (module)
+    __run_sql_query("DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;" 
+                    % (test_schema, test_schema), True)
+    __run_sql_query("GRANT ALL ON SCHEMA %s TO %s;" 
+                    % (test_schema, test_user), True)
+
+    # Switch to test user and prepare the search_path
+    pre_sql = '-- Switch to test user:\n' \
+              'SET ROLE %s;\n' \
+              '-- Set SEARCH_PATH for install-check:\n' \
+              'SET search_path=%s,%s;\n' \
+              % (test_user, test_schema, schema)
+
+    # Loop through all test SQL files for this module
+    sql_files = maddir_mod_sql + '/' + module + '/test/*.sql_in'
+    for sqlfile in sorted(glob.glob(sql_files)):
+    
+        result = 'PASS'
+
+        # Set file names
+        tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
+        logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
+        
+        # If there is no problem with the SQL file
+        milliseconds = 0
+
+        # Run the SQL
+        run_start = datetime.datetime.now()
+        retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre_sql)
+        # Runtime evaluation
+        run_end = datetime.datetime.now()
+        milliseconds = round((run_end - run_start).seconds * 1000 + (run_end - run_start).microseconds / 1000)
+
+        # Check the exit status
+        if retval != 0:
+            __error("Failed executing %s" % tmpfile, False)  
+            __error("Check the log at %s" % logfile, False) 
+            result = 'FAIL'
+            keeplogs = True
+        # Since every single statement in the test file gets logged, 
+        # an empty log file indicates an empty or a failed test
+        elif os.path.isfile(logfile) and os.path.getsize(logfile) > 0:
+            result = 'PASS'
+        # Otherwise                   
+        else:
+            result = 'ERROR'
+        
+        # Spit the line (in one write, other modules may be running)
+        sys.stdout.write("TEST CASE RESULT|Module: " + module + \
+            "|" + os.path.basename(sqlfile) + "|" + result + \
+            "|Time: %d milliseconds\n" % (milliseconds))
+
+        results.append({ 'module': module
+                       , 'file': os.path.basename(sqlfile)
+                       , 'result': result
+                       , 'milliseconds': int(milliseconds)
+                       , 'rows': __count_log_rows(logfile)
+                       })
+
+    # Cleanup test schema for the module
+    __run_sql_query( "DROP SCHEMA IF EXISTS %s CASCADE;" % (test_schema), True)
+
+    return results
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Count the result rows printed by psql in a log file, 
+# i.e., sum up all "(N rows)" footers
+# @param logfile name of the log file
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __count_log_rows(logfile):
+
+    try:
+        f = open(logfile, 'r')
+        try:
+            return sum(int(n) for n in 
+                       re.findall(r'^\((\d+) rows?\)$', f.read(), re.M))
+        finally:
+            f.close()
+    except:
+        return 0
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write install-check results to a file: JUnit XML if the
+# file name ends with .xml, JSON otherwise
+# @param filename name of the results file
+# @param results list of test results
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_install_check_results(filename, results):
+
+    try:
+        f = open(filename, 'w')
+    except:
+        __error("Cannot create results file: %s" % filename, False)
+        return
+
+    try:
+        if filename.endswith('.xml'):
+            from xml.sax.saxutils import quoteattr
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+            modules = []
+            for r in results:
+                if r['module'] not in modules:
+                    modules.append(r['module'])
+            for module in modules:
+                cases = [r for r in results if r['module'] == module]
+                f.write('  <testsuite name=%s tests="%d" failures="%d" errors="%d" time="%.3f">\n'
+                        % (quoteattr(module), len(cases),
+                           len([r for r in cases if r['result'] == 'FAIL']),
+                           len([r for r in cases if r['result'] == 'ERROR']),
+                           sum(r['milliseconds'] for r in cases) / 1000.0))
+                for r in cases:
+                    f.write('    <testcase classname=%s name=%s time="%.3f">'
+                            % (quoteattr('madlib.' + module), quoteattr(r['file']), 
+                               r['milliseconds'] / 1000.0))
+                    if r['result'] == 'FAIL':
+                        f.write('<failure message="FAIL"/>')
+                    elif r['result'] == 'ERROR':
+                        f.write('<error message="ERROR"/>')
+                    f.write('</testcase>\n')
+                f.write('  </testsuite>\n')
+            f.write('</testsuites>\n')
+        else:
+            import json
+            json.dump({ 'version': rev
+                      , 'results': results
+                      , 'slowest': sorted(results, key=lambda r: r['milliseconds'], 
+                                          reverse=True)[:10]
+                      }, f, indent=2)
+    finally:
+        f.close()
+
+    __info("> Test results written to %s" % filename, True)
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Rollback installation
 # @param drop_schema name of the schema to drop
@@ -617,6 +1814,7 @@ def __db_rollback(drop_schema, keep_schema):
     __info("> Dropping schema %s" % drop_schema.upper(), verbose)        
     try:
         __run_sql_query("DROP SCHEMA %s CASCADE;" % (drop_schema), True)
+        __clear_dbinfo()
     except:
         __error("Cannot drop schema %s. Stopping rollback..." % drop_schema.upper(), True)        
 
@@ -660,6 +1858,126 @@ def parseConnectionStr(connectionStr):
         match.group('port'),
         unescape(match.group('database')))
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Fleet mode: run the same madpack command against many databases.
+# Every target is handled by its own madpack process (up to 
+# max_jobs at a time), so the per-run global state is not shared.
+# @param command madpack command to run
+# @param fleetfile file with one connection string per line
+# @param max_jobs max number of targets processed concurrently
+# @param argv madpack arguments to pass on to every process
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_fleet(command, fleetfile, max_jobs, argv):
+
+    if command not in ('version', 'install', 'update', 'install-check'):
+        __error("Command %s is not supported in fleet mode." % command, True)
+
+    # Read the connection strings (skip empty lines and comments)
+    try:
+        f = open(fleetfile, 'r')
+        try:
+            targets = [line.strip() for line in f 
+                       if line.strip() and not line.strip().startswith('#')]
+        finally:
+            f.close()
+    except IOError:
+        __error("Cannot read fleet file: %s" % fleetfile, True)
+
+    # Drop the fleet and connection arguments from the command line.
+    # The processes cannot prompt (no terminal), so they answer Y 
+    # (e.g. an install over an existing schema renames it).
+    # The output files (--results, --profile) are set per target below.
+    child_argv = ['--yes']
+    outputs = []
+    skip = None
+    for arg in argv:
+        if skip:
+            if skip in ('--results', '--profile'):
+                outputs.append((skip, arg))
+            skip = None
+        elif arg in ('--fleet', '--fleet-jobs', '-c', '--conn', '--results', '--profile'):
+            skip = arg
+        elif re.match('^(--results|--profile)=', arg):
+            outputs.append(tuple(arg.split('=', 1)))
+        elif not re.match('^(--fleet|--fleet-jobs|--conn)=|^-c.', arg):
+            child_argv.append(arg)
+
+    # Output file of a target: FILE.<index>.<ext> (the extension selects
+    # the format of --results)
+    def target_output(path, i):
+        (root, ext) = os.path.splitext(path)
+        return "%s.%03d%s" % (root, i, ext)
+
+    # Ask for the password only once (the processes have no terminal)
+    env = dict(os.environ)
+    if 'PGPASSWORD' not in env and \
+            [t for t in targets if parseConnectionStr(t)[1] is None]:
+        env['PGPASSWORD'] = getpass.getpass("Password for fleet targets: ")
+
+    __make_dir(tmpdir + '/fleet')
+    status = {}
+
+    def run_target(i):
+        logfile = tmpdir + '/fleet/%03d.log' % i
+        log = open(logfile, 'w')
+        run_start = datetime.datetime.now()
+        try:
+            target_argv = []
+            for (option, path) in outputs:
+                target_argv.extend([option, target_output(path, i)])
+            retval = subprocess.call(
+                [sys.executable, os.path.realpath(__file__)] + child_argv 
+                    + target_argv + ['-c', targets[i]],
+                env=env, stdin=open(os.devnull, 'r'), stdout=log, stderr=log)
+        finally:
+            log.close()
+        run_end = datetime.datetime.now()
+        status[i] = (retval, (run_end - run_start).seconds, logfile)
+
+    __info("Running %s on %d databases..." % (command, len(targets)), True)
+    __run_parallel(run_target, range(len(targets)), max_jobs)
+
+    # Consolidated status table
+    print "%-40s | %-6s | %6s | %s" % ("Database", "Status", "Time", "Summary")
+    print "-" * 41 + "+" + "-" * 8 + "+" + "-" * 8 + "+" + "-" * 30
+    failures = 0
+    for i in range(len(targets)):
+        (c_user, c_pass, c_host, c_port, c_db) = parseConnectionStr(targets[i])
+        name = "%s@%s%s/%s" % (c_user or '', c_host or '', 
+                               c_port and ':' + c_port or '', c_db or '')
+        if i not in status:
+            failures += 1
+            print "%-40s | %-6s | %6s | %s" % (name, 'ERROR', '', 'not run')
+            continue
+        (retval, seconds, logfile) = status[i]
+        f = open(logfile, 'r')
+        try:
+            output = f.read()
+        finally:
+            f.close()
+        if command == 'version':
+            match = re.search('MADlib database version = (\S+)', output)
+            summary = "version " + (match.group(1) if match else 'unknown')
+        elif command == 'install-check':
+            summary = "%d passed, %d failed" % (
+                len(re.findall(r'^TEST CASE RESULT\|.*\|PASS\|', output, re.M)),
+                len(re.findall(r'^TEST CASE RESULT\|.*\|(FAIL|ERROR)\|', output, re.M)))
+        else:
+            lines = output.strip().splitlines()
+            summary = lines[-1].split(' : ', 2)[-1] if lines else ''
+        if retval != 0:
+            failures += 1
+            summary += " (see %s)" % logfile
+        for (option, path) in outputs:
+            summary += " (%s: %s)" % (option[2:], target_output(path, i))
+        print "%-40s | %-6s | %5ds | %s" % (name, 'OK' if retval == 0 else 'FAILED', 
+                                            seconds, summary)
+
+    # Keep the logs and exit with an error status if any target failed
+    if failures > 0:
+        __error("%d of %d databases failed. Log files saved in %s" 
+                % (failures, len(targets), tmpdir), True)
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Main       
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -684,6 +2002,7 @@ def main(argv):
         choices=['install','update','uninstall','reinstall','version','install-check'], 
         help = "One of the following options:\n"
             + "  install/update : run sql scripts to load into DB\n"
+            + "                   (update re-runs only the modules with changed SQL)\n"
             + "  uninstall      : run sql scripts to uninstall from DB\n"
             + "  reinstall      : performs uninstall and install\n"
             + "  version        : compare and print MADlib version (binaries vs database objects)\n"
@@ -719,6 +2038,64 @@ def main(argv):
     parser.add_argument('-d', '--tmpdir', dest='tmpdir', default = '/tmp/',
                          help="Temporary directory location for installation log files.")
 
+    parser.add_argument('-y', '--yes', dest='assume_yes', default=False,
+                         action="store_true", 
+                         help="Do not ask for confirmation (answer Y), e.g. before\n"
+                            + "renaming an existing MADlib schema.")
+
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int, default=1,
+                         help="Number of modules to install or test concurrently.\n"
+                            + "Modules are installed level by level of the\n"
+                            + "Modules.yml dependency graph (default: 1).")
+
+    parser.add_argument('-m', '--modules', dest='modules', metavar='MODULES', default=None,
+                         help="Comma-separated list of modules to install or\n"
+                            + "test (not supported for update). The modules\n"
+                            + "they depend on are added.\n"
+                            + "Note: install recreates the schema with the\n"
+                            + "selected modules only.")
+
+    parser.add_argument('-x', '--exclude', dest='exclude', metavar='MODULES', default=None,
+                         help="Comma-separated list of modules to leave out.")
+
+    parser.add_argument('--plan', dest='plan', action="store_true",
+                         help="With install/update/reinstall: only print what would\n"
+                            + "be installed (statements, bytes and objects per\n"
+                            + "module, time of the last installation). With\n"
+                            + "update: only the modules whose SQL changed since\n"
+                            + "the last installation and their dependents.")
+
+    parser.add_argument('--profile', dest='profile', metavar='FILE', default=None,
+                         help="Record the execution time of every SQL statement\n"
+                            + "run from module SQL files and write it to FILE\n"
+                            + "(JSON), with a summary of the slowest statements.")
+
+    parser.add_argument('--results', dest='results', metavar='FILE', default=None,
+                         help="Write install-check results to FILE (JUnit XML if\n"
+                            + "FILE ends with .xml, JSON otherwise).")
+
+    parser.add_argument('--single-transaction', dest='module_transaction', 
+                         action="store_true", 
+                         help="Install all SQL files of a module as one script\n"
+                            + "in a single transaction.")
+
+    parser.add_argument('--fleet', dest='fleet', metavar='FILE', default=None,
+                         help="Run the command against every database in FILE\n"
+                            + "(one connection string per line, see -c).\n"
+                            + "Supported commands: version, install, update,\n"
+                            + "install-check. Implies -y/--yes. --results and\n"
+                            + "--profile files are written per database, as\n"
+                            + "FILE.<index>.<ext> (index in FILE order, from 000).")
+
+    parser.add_argument('--fleet-jobs', dest='fleet_jobs', metavar='N', type=int, default=4,
+                         help="Number of databases processed concurrently in\n"
+                            + "fleet mode (default: 4).")
+
+    parser.add_argument('--cachedir', dest='cachedir', metavar='DIR', default=None,
+                         help="Cache m4-preprocessed SQL files in this directory\n"
+                            + "and reuse them while the sources, the m4 include\n"
+                            + "files and the defines are unchanged.")
+
     ##
     # Get the arguments
     ##
@@ -726,8 +2103,27 @@ def main(argv):
     global verbose
     verbose = args.verbose
     __info("Arguments: " + str(args), verbose);    
+    if configyml.yaml_loader:
+        __info("> Config files parsed with " + configyml.yaml_loader, verbose)
+    else:
+        __info("> Config files read from cache", verbose)
     global keeplogs
     keeplogs = args.keeplogs
+    global jobs
+    if args.jobs < 1:
+        __error("Invalid number of jobs: %d" % args.jobs, True)
+    jobs = args.jobs
+    global profile_file
+    if args.profile:
+        profile_file = os.path.abspath(args.profile)
+    global module_transaction
+    module_transaction = args.module_transaction
+    global assume_yes
+    assume_yes = args.assume_yes
+    global cachedir
+    if args.cachedir:
+        cachedir = os.path.abspath(args.cachedir)
+        __make_dir(cachedir)
 
     global tmpdir
     try:
@@ -736,6 +2132,16 @@ def main(argv):
         tmpdir = e.filename
         __error("cannot create temporary directory: '%s'." % tmpdir, True)
 
+    ##
+    # Fleet mode
+    ##
+    if args.fleet:
+        if args.fleet_jobs < 1:
+            __error("Invalid number of fleet jobs: %d" % args.fleet_jobs, True)
+        # Each target writes its own profile
+        profile_file = None
+        __run_fleet(args.command[0], args.fleet, args.fleet_jobs, argv)
+        return
         
     ##
     # Parse SCHEMA
@@ -797,11 +2203,14 @@ def main(argv):
         con_args['user'] = c_user
         con_args['password'] = c_pass    
 
+        # Open the connection used for all SQL queries of this run
+        __db_connect()
+
         # Get MADlib version in DB
         dbrev = __get_madlib_dbver(schema)
         
         # Get DB version
-        dbver = __get_dbver()
+        dbver = __get_dbver(schema)
         __info("Detected %s version %s." % (ports[portid]['name'], dbver), True)
         portdir = os.path.join(maddir, "ports", portid)
         if not os.path.isdir(os.path.join(portdir, dbver)):
@@ -814,7 +2223,7 @@ def main(argv):
                 ), True)
         
         # Validate that db platform is correct 
-        if __check_db_port(portid) == False:
+        if __check_db_port(portid, schema) == False:
             __error("Invalid database platform specified.", True)
             
         # Adjust MADlib directories for this port (if they exist)
@@ -826,9 +2235,37 @@ def main(argv):
                 "/lib/libmadlib.so"):
             maddir_lib  = maddir + "/ports/" + portid + "/" + dbver + \
                 "/lib/libmadlib.so"
-        # Get the list of modules for this port
+        # Get the list of modules for this port (only the commands
+        # creating or testing objects need it)
         global portspecs
-        portspecs = configyml.get_modules(maddir_conf)                   
+        if args.command[0] in ('install', 'update', 'reinstall', 'install-check'):
+            # A port specific Modules.yml (if any) adds or replaces modules
+            # of the main one
+            overlays = []
+            if maddir_conf == maddir + "/config":
+                overlays.append(maddir + "/ports/" + portid + "/config")
+            try:
+                portspecs = configyml.get_config_modules(config, maddir_conf,
+                                                         overlays, portid, dbver)
+            except configyml.MadPackConfigError as e:
+                __error(e.value, True)
+
+            # Restrict it to the selected modules. The version recorded by 
+            # an update covers the whole schema, so update takes them all.
+            if args.modules or args.exclude:
+                if args.command[0] == 'update':
+                    __error("-m/--modules and -x/--exclude are not supported for update "
+                            "(it updates every changed module and records the version "
+                            "for the whole schema).", True)
+                try:
+                    portspecs = configyml.select_modules(portspecs,
+                        args.modules and args.modules.split(','),
+                        args.exclude and args.exclude.split(','),
+                        args.command[0] != 'install-check')
+                except configyml.MadPackConfigError as e:
+                    __error("Invalid module selection: %s" % e.value, True)
+                __info("Selected modules: %s" 
+                        % ", ".join([m['name'] for m in portspecs['modules']]), True)
     else:
         con_args = None
         dbrev = None
@@ -848,6 +2285,18 @@ def main(argv):
         if not con_args:
             __error("Unknown problem with database connection string: %s" % con_args, True)
    
+    ###
+    # Installation plan only (nothing is executed)
+    ###
+    if args.plan:
+        if args.command[0] not in ('install', 'update', 'reinstall'):
+            __error("--plan is only supported for install, update and reinstall.", True)
+        try:
+            __db_plan(schema, args.command[0], dbrev)
+        except:
+            __error("Cannot build the installation plan.", True)
+        return
+
     ###
     # COMMAND: version
     ###
@@ -864,8 +2313,8 @@ def main(argv):
             __info("Nothing to uninstall. No version found in schema %s." % schema.upper(), True)
             return
 
-        # Find any potential data to lose
-        affected_objects = __run_sql_query("""
+        # Find any potential data to lose (rows are printed as they are read)
+        affected_objects = __iter_sql_query("""
             SELECT 
                 n1.nspname AS schema,
                 relname AS relation, 
@@ -892,15 +2341,14 @@ def main(argv):
         __info("*** Uninstalling MADlib ***", True)        
         __info("***********************************************************************************", True)
         __info("* Schema %s and all database objects depending on it will be dropped!" % schema.upper(), True)
-        if affected_objects:
-            __info("* If you continue the following data will be lost (schema : table.column : type):", True)
-            for ao in affected_objects:
-                __info ( '* - ' + ao['schema'] + ' : ' + ao['relation'] + '.' + ao['column'] + ' : ' + ao['type'], True);
+        found = False
+        for ao in affected_objects:
+            if not found:
+                __info("* If you continue the following data will be lost (schema : table.column : type):", True)
+                found = True
+            __info ( '* - ' + ao['schema'] + ' : ' + ao['relation'] + '.' + ao['column'] + ' : ' + ao['type'], True);
         __info("***********************************************************************************", True)
-        __info("Would you like to continue? [Y/N]", True)
-        go = raw_input('>>> ').upper()
-        while go != 'Y' and go != 'N':
-            go = raw_input('Yes or No >>> ').upper()
+        go = __confirm()
         
         # 2) Do the uninstall/drop     
         if go == 'N':            
@@ -913,6 +2361,7 @@ def main(argv):
                 __run_sql_query("DROP SCHEMA %s CASCADE;" % (schema), True)
             except:
                 __error("Cannot drop schema %s." % schema.upper(), True)         
+            __clear_dbinfo()
 
             __info('Schema %s (and all dependent objects) has been dropped.' % schema.upper(), True)
             __info('MADlib uninstalled successfully.', True)
@@ -942,8 +2391,11 @@ def main(argv):
 
         # 2) Run installation 
         try:
-            __plpy_check(py_min_ver)
-            __db_install(schema, dbrev)
+            __plpy_check(py_min_ver, schema)
+            if args.command[0] == 'update':
+                __db_update(schema, dbrev)
+            else:
+                __db_install(schema, dbrev)
         except:
             __error("MADlib installation failed.", True)
            
@@ -975,84 +2427,25 @@ def main(argv):
         # 2) Run test SQLs 
         __info("> Running test scripts for:", verbose)   
         
-        # Loop through all modules 
-        for moduleinfo in portspecs['modules']:
-        
-            # Get module name
-            module = moduleinfo['name']
-            __info("> - %s" % module, verbose)        
-
-            # Make a temp dir for this module (if doesn't exist)
-            cur_tmpdir = tmpdir + '/' + module + '/test'
-            __make_dir(cur_tmpdir)
-            
-            # Find the Python module dir (platform specific or generic)
-            if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
-                maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
-            else:        
-                maddir_mod_py  = maddir + "/modules"
-            
-            # Find the SQL module dir (platform specific or generic)
-            if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
-                maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
-            else:        
-                maddir_mod_sql  = maddir + "/modules"
-
-            # Prepare test schema
-            test_schema = "madlib_installcheck_%s" % (module)
-            __run_sql_query("DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;" 
-                            % (test_schema, test_schema), True)
-            __run_sql_query("GRANT ALL ON SCHEMA %s TO %s;" 
-                            % (test_schema, test_user), True)
-
-            # Switch to test user and prepare the search_path
-            pre_sql = '-- Switch to test user:\n' \
-                      'SET ROLE %s;\n' \
-                      '-- Set SEARCH_PATH for install-check:\n' \
-                      'SET search_path=%s,%s;\n' \
-                      % (test_user, test_schema, schema)
-    
-            # Loop through all test SQL files for this module
-            sql_files = maddir_mod_sql + '/' + module + '/test/*.sql_in'
-            for sqlfile in sorted(glob.glob(sql_files)):
-            
-                result = 'PASS'
-
-                # Set file names
-                tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
-                logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
-                
-                # If there is no problem with the SQL file
-                milliseconds = 0
-
-                # Run the SQL
-                run_start = datetime.datetime.now()
-                retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile, tmpfile, logfile, pre_sql)
-                # Runtime evaluation
-                run_end = datetime.datetime.now()
-                milliseconds = round((run_end - run_start).seconds * 1000 + (run_end - run_start).microseconds / 1000)
-
-                # Check the exit status
-                if retval != 0:
-                    __error("Failed executing %s" % tmpfile, False)  
-                    __error("Check the log at %s" % logfile, False) 
-                    result = 'FAIL'
-                    keeplogs = True
-                # Since every single statement in the test file gets logged, 
-                # an empty log file indicates an empty or a failed test
-                elif os.path.isfile(logfile) and os.path.getsize(logfile) > 0:
-                    result = 'PASS'
-                # Otherwise                   
-                else:
-                    result = 'ERROR'
-                
-                # Spit the line
-                print "TEST CASE RESULT|Module: " + module + \
-                    "|" + os.path.basename(sqlfile) + "|" + result + \
-                    "|Time: %d milliseconds" % (milliseconds)           
-
-            # Cleanup test schema for the module
-            __run_sql_query( "DROP SCHEMA IF EXISTS %s CASCADE;" % (test_schema), True)
+        # Loop through all modules (each one has its own test schema, 
+        # so with --jobs > 1 several modules are tested concurrently)
+        results = []
+        modules = [m['name'] for m in portspecs['modules']]
+        failed = __run_parallel(lambda module: results.extend(
+                                    __db_install_check_module(schema, test_user, module)),
+                                modules, jobs)
+        if failed:
+            __error("Install-check failed for modules: %s" % ", ".join(failed), False)
+        results.sort(key=lambda r: modules.index(r['module']))
+
+        # Summary of the slowest test files
+        slowest = sorted(results, key=lambda r: r['milliseconds'], reverse=True)[:10]
+        __info("> Slowest test scripts:", verbose)
+        for r in slowest:
+            __info(">   %s/%s: %d milliseconds" % (r['module'], r['file'], r['milliseconds']), verbose)
+
+        if args.results:
+            __write_install_check_results(args.results, results)
 
         # Drop install-check user
         __run_sql_query( "DROP OWNED BY %s CASCADE;" % (test_user), True)
@@ -1064,8 +2457,14 @@ def main(argv):
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 if __name__ == "__main__":
 
-    # Run main
-    main(sys.argv[1:])
+    # Run main (and write the profile even if it fails)
+    try:
+        main(sys.argv[1:])
+    finally:
+        __write_profile()
+
+    # Close the database connection
+    __db_disconnect()
 
     # Optional log files cleanup    
     if keeplogs is False:
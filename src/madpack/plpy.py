@@ -6,6 +6,12 @@
 # 
 # ==============================================================================
 import sys
+import re
+import threading
+import array
+import time
+import os
+import cPickle
 from types import *
 
 try:
@@ -18,7 +24,633 @@ except Exception, e:
         sys.stderr.write(str(errorMsg))
         sys.exit(2)
               
+# Max number of prepared plans kept on each connection (least recently
+# used plans are deallocated first)
+PLAN_CACHE_SIZE = 100
+
+# ------------------------------------------------------------------------------
+# A query prepared with plpy.prepare(). The plan itself does not belong to a 
+# connection: each connection prepares it (PREPARE) the first time it is 
+# executed there and keeps it in its plan cache.
+# ------------------------------------------------------------------------------
+class PLPlan:
+
+    def __init__( self, query, argtypes):
+        self.query = query
+        self.argtypes = list( argtypes or [])
+        self.key = (query, tuple( self.argtypes))
+
+INFINITY = float( '1e400')
+
+# ------------------------------------------------------------------------------
+# Returns SQL text as UTF-8 bytes: unicode is encoded, str is assumed to be 
+# UTF-8 already. Queries are built from such bytes only, so that unicode and 
+# non-ASCII str values are never mixed (implicit ASCII conversion).
+# ------------------------------------------------------------------------------
+def utf8( text):
+    if type(text) is UnicodeType:
+        return text.encode('utf-8')
+    return text
+
+# ------------------------------------------------------------------------------
+# Quotes a Python value as a SQL literal (used for plan arguments)
+# ------------------------------------------------------------------------------
+def quote_literal( val):
+    if val is None:
+        return 'NULL'
+    elif type(val) is BooleanType:
+        return val and 'TRUE' or 'FALSE'
+    elif type(val) in (IntType, LongType):
+        return str( val)
+    elif type(val) is FloatType:
+        if val != val:
+            return "'NaN'::float8"
+        elif val in (INFINITY, -INFINITY):
+            return "'%sInfinity'::float8" % (val < 0 and '-' or '')
+        return repr( val)
+    elif type(val) in (ListType, TupleType):
+        if len( val) == 0:
+            return "'{}'"
+        return 'ARRAY[' + ', '.join( [quote_literal( v) for v in val]) + ']'
+    else:
+        if type(val) is not UnicodeType:
+            val = str( val)
+        return "E'" + utf8( val).replace( '\\', '\\\\').replace( "'", "''") + "'"
+
+# ------------------------------------------------------------------------------
+# COPY text format: field values are escaped as below, NULL is \N
+# ------------------------------------------------------------------------------
+COPY_ESCAPES = { '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+COPY_UNESCAPES = { 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+COPY_ESCAPE_RE = re.compile( r'[\\\t\n\r]')
+COPY_UNESCAPE_RE = re.compile( r'\\([0-7]{1,3}|x[0-9a-fA-F]{1,2}|.)')
+
+# Max size of the buffer sent to the server at once by copy_from()
+COPY_CHUNK_SIZE = 65536
+
+# Formats a Python value as an element of an array literal
+def copy_array_elem( val):
+    if val is None:
+        return 'NULL'
+    elif type(val) in (ListType, TupleType):
+        return '{' + ','.join( [copy_array_elem( v) for v in val]) + '}'
+    val = copy_value( val)
+    return '"' + val.replace( '\\', '\\\\').replace( '"', '\\"') + '"'
+
+# Formats a Python value as a (not yet escaped) COPY text field
+def copy_value( val):
+    if type(val) is BooleanType:
+        return val and 't' or 'f'
+    elif type(val) in (IntType, LongType):
+        return str( val)
+    elif type(val) is FloatType:
+        if val != val:
+            return 'NaN'
+        elif val in (INFINITY, -INFINITY):
+            return (val < 0 and '-' or '') + 'Infinity'
+        return repr( val)
+    elif type(val) in (ListType, TupleType):
+        return '{' + ','.join( [copy_array_elem( v) for v in val]) + '}'
+    elif type(val) is UnicodeType:
+        return val.encode('utf-8')
+    else:
+        return str( val)
+
+# Formats a row as a line of COPY text format
+def copy_line( row):
+    fields = []
+    for val in row:
+        if val is None:
+            fields.append( '\\N')
+        else:
+            fields.append( COPY_ESCAPE_RE.sub( 
+                lambda m: COPY_ESCAPES[m.group(0)], copy_value( val)))
+    return '\t'.join( fields) + '\n'
+
+def copy_unescape_char( m):
+    c = m.group(1)
+    if c[0] in '01234567':
+        return chr( int( c, 8) & 0xff)
+    elif c[0] == 'x' and len( c) > 1:
+        return chr( int( c[1:], 16))
+    return COPY_UNESCAPES.get( c, c)
+
+# Parses a line of COPY text format into a tuple of strings (None for NULL)
+def copy_parse( line):
+    values = []
+    for f in line.split( '\t'):
+        if f == '\\N':
+            values.append( None)
+        else:
+            values.append( COPY_UNESCAPE_RE.sub( copy_unescape_char, f))
+    return tuple( values)
+
+# ------------------------------------------------------------------------------
+# Statement instrumentation (see set_instrumentation): when on, every
+# statement run by execute() and every PREPARE is timed and aggregated by
+# its fingerprint (the SQL text with comments removed, literals replaced 
+# by ? and white space collapsed)
+# ------------------------------------------------------------------------------
+instrumented = False
+stats = {}          # fingerprint -> [calls, total ms, max ms, rows]
+stats_lock = threading.Lock()
+hooks = []          # functions called with (fingerprint, sql, ms, rows)
+
+FINGERPRINT_RES = [ (re.compile( r'--[^\n]*|/\*.*?\*/', re.S), ' ')
+                  , (re.compile( r"[eE]?'(?:[^'\\]|''|\\.)*'"), '?')
+                  , (re.compile( r'(?<![\w$.])\d+(?:\.\d*)?(?:[eE][-+]?\d+)?'), '?')
+                  , (re.compile( r'\?(?:\s*,\s*\?)+'), '?, ...')
+                  , (re.compile( r'\s+'), ' ')
+                  ]
+
+# Returns the normalized form of a statement used to aggregate statistics
+def fingerprint( sql):
+    for (regex, repl) in FINGERPRINT_RES:
+        sql = regex.sub( repl, sql)
+    return sql.strip().rstrip(';').strip()
+
+# Records one run of a statement
+def record( sql, ms, rows):
+    fp = fingerprint( sql)
+    stats_lock.acquire()
+    try:
+        st = stats.setdefault( fp, [0, 0.0, 0.0, 0])
+        st[0] += 1
+        st[1] += ms
+        st[2] = max( st[2], ms)
+        st[3] += rows
+    finally:
+        stats_lock.release()
+    for hook in hooks:
+        hook( fp, sql, ms, rows)
+
+# Returns the number of rows of an execute() result
+def result_rows( rv):
+    if type(rv) is StringType:
+        if rv.isdigit():
+            return int( rv)
+        return 0
+    elif type(rv) in (IntType, LongType):
+        return rv
+    return len( rv)
+
+# ------------------------------------------------------------------------------
+# Timeouts and retries (see set_statement_timeout and Connection.execute)
+# ------------------------------------------------------------------------------
+statement_timeout = 0   # ms, 0 = no timeout
+RETRY_COUNT = 3         # max retries of an idempotent statement
+RETRY_DELAY = 1.0       # seconds before the first retry (doubled each time)
+reconnect_hooks = []    # functions called with the connection after a reconnect
+checkpoint_dir = None   # directory of the checkpoint() files
+
+# Default number of rows fetched per round trip by cursor()
+CURSOR_BATCH_SIZE = 1000
+
+# Result mode of execute(): 'dict' returns a list of dicts (one per row),
+# 'columns' returns a PLResult (see set_result_mode)
+result_mode = 'dict'
+
+# ------------------------------------------------------------------------------
+# One row of a PLResult. Behaves like a read-only dict (row['col'], keys(),
+# items(), get(), 'col' in row) without allocating one.
+# ------------------------------------------------------------------------------
+class PLRow(object):
+
+    __slots__ = ('index', 'values')
+
+    def __init__( self, index, values):
+        self.index = index
+        self.values = values
+
+    def __getitem__( self, col):
+        return self.values[self.index[col]]
+
+    def get( self, col, default = None):
+        if col in self.index:
+            return self.values[self.index[col]]
+        return default
+
+    def keys( self):
+        return self.index.keys()
+
+    def items( self):
+        return [(col, self.values[i]) for (col, i) in self.index.iteritems()]
+
+    def has_key( self, col):
+        return col in self.index
+
+    def __contains__( self, col):
+        return col in self.index
+
+    def __iter__( self):
+        return iter( self.index)
+
+    def __len__( self):
+        return len( self.values)
+
+    def __eq__( self, other):
+        return dict( self.items()) == other
+
+    def __ne__( self, other):
+        return not self.__eq__( other)
+
+    def __repr__( self):
+        return repr( dict( self.items()))
+
+# ------------------------------------------------------------------------------
+# Column-oriented query result: the rows are kept as the tuples returned by 
+# the driver. Supports rv.nrows(), len(rv), rv[i]['col'] and iteration like
+# the list of dicts, plus rv.column('col') for whole columns (array.array 
+# for numeric columns without NULLs, tuple otherwise).
+# ------------------------------------------------------------------------------
+class PLResult(object):
+
+    def __init__( self, fields, rows):
+        self.fields = list( fields)
+        self.index = dict( [(col, i) for (i, col) in enumerate( self.fields)])
+        self.rows = rows
+        self.columns = {}
+
+    def nrows( self):
+        return len( self.rows)
+
+    def __len__( self):
+        return len( self.rows)
+
+    def __getitem__( self, i):
+        if type(i) is SliceType:
+            return [PLRow( self.index, r) for r in self.rows[i]]
+        return PLRow( self.index, self.rows[i])
+
+    def __iter__( self):
+        for r in self.rows:
+            yield PLRow( self.index, r)
+
+    def column( self, col):
+        if col not in self.columns:
+            i = self.index[col]
+            values = tuple( [r[i] for r in self.rows])
+            kinds = set( [type(v) for v in values])
+            try:
+                if kinds and kinds <= set( [IntType, LongType]):
+                    values = array.array( 'l', values)
+                elif kinds and kinds <= set( [IntType, LongType, FloatType]):
+                    values = array.array( 'd', values)
+            except OverflowError:
+                pass
+            self.columns[col] = values
+        return self.columns[col]
+
+# Switches the result mode of execute() between 'dict' (list of dicts, the 
+# default) and 'columns' (PLResult)
+def set_result_mode( mode):
+    global result_mode
+    if mode not in ('dict', 'columns'):
+        raise ValueError( "invalid result mode: %s" % mode)
+    result_mode = mode
+
+# ------------------------------------------------------------------------------
+# A database connection with its own LRU cache of prepared plans
+# ------------------------------------------------------------------------------
+class Connection:
+
+    def __init__( self, dbname, host, port, user, passwd):
+        self.conargs = (dbname, host, port, user, passwd)
+        self.open()
+        self.ncursors = 0
+
+    def open( self):
+        (dbname, host, port, user, passwd) = self.conargs
+        self.db = pg.DB(  dbname=dbname
+                        , host=host 
+                        , port=port
+                        , user=user
+                        , passwd=passwd
+                        )
+        self.plans = {}     # plan key -> name of the prepared statement
+        self.lru = []       # plan keys, least recently used first
+        self.nplans = 0
+        self.timeout = 0    # statement_timeout set on this connection
+
+    # Returns False if the connection to the server is lost
+    # (from the status of the libpq connection, which is not affected by 
+    # errors of the statements or an aborted transaction)
+    def alive( self):
+        try:
+            return bool( self.db.status)
+        except AttributeError:
+            # No status with this driver: assume the connection is alive
+            return True
+        except Exception:
+            # The driver refuses to use a closed or broken connection
+            return False
+
+    # Opens a new connection after the old one was lost, retrying up to
+    # RETRY_COUNT times, and runs the reconnect hooks
+    def reconnect( self):
+        global db
+        try:
+            self.db.close()
+        except Exception:
+            pass
+        for attempt in range( RETRY_COUNT + 1):
+            try:
+                self.open()
+                break
+            except Exception:
+                if attempt == RETRY_COUNT:
+                    raise
+                time.sleep( RETRY_DELAY * 2 ** attempt)
+        if self is con:
+            db = self.db
+        for hook in reconnect_hooks:
+            hook( self)
+
+    # Sets statement_timeout on this connection if it changed
+    def set_timeout( self):
+        if self.timeout != statement_timeout:
+            self.db.query( 'SET statement_timeout = %d' % statement_timeout)
+            self.timeout = statement_timeout
+
+    # Returns the name of the prepared statement for a plan (PREPAREs it
+    # on this connection if needed)
+    def prepared( self, plan):
+        if plan.key in self.plans:
+            self.lru.remove( plan.key)
+            self.lru.append( plan.key)
+            return self.plans[plan.key]
+
+        self.nplans += 1
+        name = 'plpy_plan_%d' % self.nplans
+        sql = 'PREPARE ' + name
+        if plan.argtypes:
+            sql += ' (' + ', '.join( [utf8( t) for t in plan.argtypes]) + ')'
+        sql += ' AS ' + utf8( plan.query)
+        if instrumented:
+            start = time.time()
+            self.db.query( sql)
+            record( 'PREPARE ' + utf8( plan.query), (time.time() - start) * 1000, 0)
+        else:
+            self.db.query( sql)
+        self.plans[plan.key] = name
+        self.lru.append( plan.key)
+
+        # Evict the least recently used plan
+        if len( self.lru) > PLAN_CACHE_SIZE:
+            old = self.lru.pop( 0)
+            self.db.query( 'DEALLOCATE ' + self.plans.pop( old))
+        return name
+
+    # Runs a query or a plan, see plpy.execute(). If the connection is lost
+    # and the caller declared the statement idempotent, reconnects and runs
+    # it again (up to RETRY_COUNT times).
+    def execute( self, query, args = None, limit = 0, idempotent = False):
+        attempt = 0
+        while True:
+            try:
+                self.set_timeout()
+                return self.run( query, args, limit)
+            except Exception:
+                if not idempotent or attempt >= RETRY_COUNT or self.alive():
+                    raise
+                info( 'connection lost, retrying (%d/%d)' % (attempt + 1, RETRY_COUNT))
+                time.sleep( RETRY_DELAY * 2 ** attempt)
+                attempt += 1
+                self.reconnect()
+
+    def run( self, query, args, limit):
+        if isinstance( query, PLPlan):
+            sql = 'EXECUTE ' + self.prepared( query)
+            if query.argtypes:
+                sql += '(' + ', '.join( [quote_literal( a) for a in (args or [])]) + ')'
+        else:
+            # plpy.execute( query, max_rows)
+            if type(args) in (IntType, LongType):
+                limit = args
+            sql = utf8( query)
+        if not instrumented:
+            return self.result( self.db.query( sql), limit)
+        start = time.time()
+        rv = self.result( self.db.query( sql), limit)
+        if isinstance( query, PLPlan):
+            sql = utf8( query.query)
+        record( sql, (time.time() - start) * 1000, result_rows( rv))
+        return rv
+
+    # Converts a query result according to the result mode
+    def result( self, rv, limit):
+        if type(rv) is NoneType:
+            return 0
+        elif type(rv) is StringType:
+            return rv
+        elif result_mode == 'columns':
+            rows = rv.getresult()
+            if limit > 0:
+                rows = rows[:limit]
+            return PLResult( rv.listfields(), rows)
+        elif limit > 0:
+            return rv.dictresult()[:limit]
+        else:
+            return rv.dictresult()
+
+    # Runs a query through a server-side cursor, see plpy.cursor()
+    def cursor( self, query, batch_size = CURSOR_BATCH_SIZE):
+        self.ncursors += 1
+        name = 'plpy_cursor_%d' % self.ncursors
+        batch_size = max( batch_size, 1)
+        self.db.query( 'DECLARE ' + name + ' NO SCROLL CURSOR WITH HOLD FOR ' + utf8( query))
+        ok = False
+        try:
+            fetch = 'FETCH FORWARD %d FROM %s' % (batch_size, name)
+            while True:
+                rv = self.db.query( fetch)
+                if result_mode == 'columns':
+                    rows = PLResult( rv.listfields(), rv.getresult())
+                else:
+                    rows = rv.dictresult()
+                for row in rows:
+                    yield row
+                if len( rows) < batch_size:
+                    break
+            ok = True
+        finally:
+            # The cursor may already be gone if the transaction it was 
+            # declared in was rolled back
+            try:
+                self.db.query( 'CLOSE ' + name)
+            except Exception:
+                if ok:
+                    raise
+
+    # Loads rows into a table with COPY FROM STDIN, see plpy.copy_from().
+    # The COPY runs under a savepoint (or in its own transaction outside of
+    # a transaction block) so that nothing is loaded if it fails halfway.
+    def copy_from( self, table, rows, columns = None):
+        sql = 'COPY ' + utf8( table)
+        if columns:
+            sql += ' (' + ', '.join( [utf8( c) for c in columns]) + ')'
+        try:
+            self.db.query( 'SAVEPOINT plpy_copy')
+            intrans = True
+        except Exception:
+            self.db.query( 'BEGIN')
+            intrans = False
+        count = 0
+        ok = False
+        try:
+            self.db.query( sql + ' FROM STDIN')
+            try:
+                buf = []
+                size = 0
+                for row in rows:
+                    line = copy_line( row)
+                    buf.append( line)
+                    size += len( line)
+                    count += 1
+                    if size >= COPY_CHUNK_SIZE:
+                        self.db.putline( ''.join( buf))
+                        buf = []
+                        size = 0
+                buf.append( '\\.\n')
+                self.db.putline( ''.join( buf))
+            finally:
+                self.db.endcopy()
+            ok = True
+        finally:
+            if ok and intrans:
+                self.db.query( 'RELEASE SAVEPOINT plpy_copy')
+            elif ok:
+                self.db.query( 'COMMIT')
+            elif intrans:
+                self.db.query( 'ROLLBACK TO SAVEPOINT plpy_copy')
+                self.db.query( 'RELEASE SAVEPOINT plpy_copy')
+            else:
+                self.db.query( 'ROLLBACK')
+        return count
+
+    # Reads a table or query with COPY TO STDOUT, see plpy.copy_to()
+    def copy_to( self, source, columns = None):
+        if source.lstrip()[:6].upper() in ('SELECT', 'VALUES'):
+            sql = 'COPY (' + utf8( source) + ')'
+        else:
+            sql = 'COPY ' + utf8( source)
+            if columns:
+                sql += ' (' + ', '.join( [utf8( c) for c in columns]) + ')'
+        self.db.query( sql + ' TO STDOUT')
+        try:
+            while True:
+                line = self.db.getline()
+                if line is None or line == '\\.':
+                    break
+                yield copy_parse( line)
+        finally:
+            self.db.endcopy()
+
+    def close( self):
+        self.db.close()
+
+# ------------------------------------------------------------------------------
+# A small pool of connections to the same database
+# ------------------------------------------------------------------------------
+class Pool:
+
+    def __init__( self, size, dbname, host, port, user, passwd):
+        self.size = max( size, 1)
+        self.conargs = (dbname, host, port, user, passwd)
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+
+    # Returns an idle connection, opens a new one if the pool is not full
+    # or waits for one to be released
+    def acquire( self):
+        self.cond.acquire()
+        try:
+            while not self.idle and self.count >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        finally:
+            self.cond.release()
+        try:
+            return Connection( *self.conargs)
+        except:
+            self.cond.acquire()
+            self.count -= 1
+            self.cond.notify()
+            self.cond.release()
+            raise
+
+    def release( self, con):
+        self.cond.acquire()
+        self.idle.append( con)
+        self.cond.notify()
+        self.cond.release()
+
+    def close( self):
+        self.cond.acquire()
+        for con in self.idle:
+            con.close()
+        self.idle = []
+        self.count = 0
+        self.cond.release()
+
+# ------------------------------------------------------------------------------
+# The pending result of execute_async(): the query runs in its own thread on 
+# a connection taken from the pool
+# ------------------------------------------------------------------------------
+class PLFuture:
+
+    def __init__( self, query, args, limit):
+        self.rv = None
+        self.exc = None
+        self.event = threading.Event()
+        self.thread = None
+        if pool.size < 2:
+            # The session connection holds the only slot of the pool, so no
+            # other connection can ever be acquired: run the query right 
+            # away on the session connection
+            self.run( con, query, args, limit)
+        else:
+            self.thread = threading.Thread( target = self.run_pooled, args = (query, args, limit))
+            self.thread.setDaemon( True)
+            self.thread.start()
+
+    def run_pooled( self, query, args, limit):
+        try:
+            c = pool.acquire()
+        except:
+            self.exc = sys.exc_info()
+            self.event.set()
+            return
+        try:
+            self.run( c, query, args, limit)
+        finally:
+            pool.release( c)
+
+    def run( self, c, query, args, limit):
+        try:
+            self.rv = c.execute( query, args, limit)
+        except:
+            self.exc = sys.exc_info()
+        self.event.set()
+
+    def done( self):
+        return self.event.isSet()
+
+    # Waits for the query and returns its result (or raises its error)
+    def result( self, timeout = None):
+        self.event.wait( timeout)
+        if not self.event.isSet():
+            raise RuntimeError( "query did not complete in %s seconds" % timeout)
+        if self.exc:
+            raise self.exc[0], self.exc[1], self.exc[2]
+        return self.rv
+
 # This method establishes the connection to a database.
+# The connection used by execute() is taken from a pool of up to 
+# poolsize connections; other threads can use acquire()/release().
 #
 # Example: 
 # ----- my_run_kmeans.py -----
@@ -29,17 +661,21 @@ except Exception, e:
 # ...
 # print kmeans.kmeans_run( 50, 1);
 # ----------
-def connect ( dbname, host, port, user, passwd):
-    global db 
-    db = pg.DB(  dbname=dbname
-               , host=host 
-               , port=port
-               , user=user
-               , passwd=passwd
-               );
+def connect ( dbname, host, port, user, passwd, poolsize = 1):
+    global db, con, pool
+    pool = Pool( poolsize, dbname, host, port, user, passwd)
+    con = pool.acquire()
+    db = con.db
 
 def close():             
-    db.close()
+    pool.release( con)
+    pool.close()
+
+def acquire():
+    return pool.acquire()
+
+def release( c):
+    pool.release( c)
                               
 # The following functions should be used inside the user modules
 # in order to make their code uniform for both external python scripts 
@@ -53,15 +689,157 @@ def close():
 # ...
 # plpy.execute( 'CREATE TEMP TABLE a (a INT)');
 # plpy.info( 'Created table a.');
+# plan = plpy.prepare( 'SELECT * FROM a WHERE a > $1', ['int']);
+# rv = plpy.execute( plan, [10]);
 # ----------                    
-def execute( sql):             
-    rv = db.query( sql.encode('utf-8'))
-    if type(rv) is NoneType:
-        return 0
-    elif type(rv) is StringType:
-        return rv
-    else:
-        return rv.dictresult()
+def prepare( query, argtypes = None):
+    return PLPlan( query, argtypes)
+
+# Runs a query or a plan (prepared with prepare()). Pass idempotent=True
+# for statements that can safely run again (e.g. reads without volatile
+# functions or side effects): if the connection is lost while they run, 
+# it is reopened and they are retried. Other statements are never retried.
+def execute( query, args = None, limit = 0, idempotent = False):             
+    return con.execute( query, args, limit, idempotent)
+
+# Returns a generator over the rows of a query, fetched batch_size rows at 
+# a time from a server-side cursor, so that large relations can be walked
+# with bounded client memory. The cursor is declared WITH HOLD on the 
+# session connection: it sees the temporary tables and uncommitted changes
+# of the session, and statements run with execute() while iterating are 
+# not affected by the cursor (they are neither rolled back when the loop 
+# ends early nor able to break the next FETCH). Outside of a transaction 
+# block the server materializes the result of the query when the cursor 
+# is declared. The cursor is closed once all rows are read or when the 
+# generator is closed.
+#
+# Example:
+# for row in plpy.cursor( 'SELECT * FROM points', 10000):
+#     ...
+def cursor( query, batch_size = CURSOR_BATCH_SIZE):
+    return con.cursor( query, batch_size)
+
+# Bulk loads an iterable of rows (tuples in the order of columns, or of 
+# the table columns if not given) with COPY, sent in chunks of up to 
+# COPY_CHUNK_SIZE bytes. Returns the number of rows loaded. If reading or
+# loading the rows fails, no row is loaded.
+#
+# Example:
+# plpy.copy_from( 'centroids', [(1, [0.5, 1.0]), (2, [2.0, 3.5])], ['cid', 'coords'])
+def copy_from( table, rows, columns = None):
+    return con.copy_from( table, rows, columns)
+
+# Returns a generator over the rows of a table (or of a SELECT query) read
+# with COPY; values are returned as strings (None for NULL).
+def copy_to( source, columns = None):
+    return con.copy_to( source, columns)
+
+# Starts a query on another connection of the pool and returns a PLFuture.
+# Independent queries can overlap as long as the pool has idle connections
+# (see the poolsize argument of connect()); otherwise they wait for one.
+# With the default poolsize of 1 the query runs synchronously on the 
+# session connection and the returned future is already done.
+#
+# Example:
+# f1 = plpy.execute_async( 'SELECT count(distinct row_num) AS n FROM a')
+# f2 = plpy.execute_async( 'SELECT count(*) AS n FROM a')
+# rows = f1.result()[0]['n']; total = f2.result()[0]['n']
+def execute_async( query, args = None, limit = 0):
+    return PLFuture( query, args, limit)
+
+# Waits for a list of futures and returns their results in the same order
+def wait_all( futures):
+    return [f.result() for f in futures]
+
+# Switches statement instrumentation on or off for this session
+def set_instrumentation( on = True):
+    global instrumented
+    instrumented = on
+
+# Registers a function called after each instrumented statement with
+# (fingerprint, sql, ms, rows)
+def add_hook( func):
+    hooks.append( func)
+
+def reset_stats():
+    stats_lock.acquire()
+    stats.clear()
+    stats_lock.release()
+
+# Returns the aggregated statistics as a list of dicts, sorted by total time
+def get_stats():
+    stats_lock.acquire()
+    try:
+        rv = [{ 'statement': fp, 'calls': st[0], 'total_ms': st[1]
+              , 'avg_ms': st[1] / st[0], 'max_ms': st[2], 'rows': st[3]}
+              for (fp, st) in stats.iteritems()]
+    finally:
+        stats_lock.release()
+    rv.sort( key = lambda st: st['total_ms'], reverse = True)
+    return rv
+
+# Prints the top statements by total time
+def report( top = 10):
+    info( '%10s %8s %10s %10s %10s  %s' % ('total ms', 'calls', 'avg ms', 'max ms', 'rows', 'statement'))
+    for st in get_stats()[:top]:
+        stmt = st['statement']
+        if len( stmt) > 120:
+            stmt = stmt[:117] + '...'
+        info( '%10.1f %8d %10.1f %10.1f %10d  %s' % (st['total_ms'], st['calls']
+              , st['avg_ms'], st['max_ms'], st['rows'], stmt))
+
+# Sets the statement timeout (in ms, 0 to disable) of all connections; 
+# statements running longer are cancelled by the server
+def set_statement_timeout( ms):
+    global statement_timeout
+    statement_timeout = int( ms)
+
+# Registers a function called with the connection after it was reopened 
+# (e.g. to recreate temporary tables or session settings)
+def add_reconnect_hook( func):
+    reconnect_hooks.append( func)
+
+# Sets the directory used by checkpoint() and restore()
+def set_checkpoint_dir( path):
+    global checkpoint_dir
+    if not os.path.isdir( path):
+        os.makedirs( path)
+    checkpoint_dir = path
+
+# Saves the state of a driver (any picklable value) under a name, so that 
+# an interrupted run can resume with restore()
+def checkpoint( name, state):
+    if checkpoint_dir is None:
+        return
+    fname = os.path.join( checkpoint_dir, name + '.ckpt')
+    f = open( fname + '.tmp', 'wb')
+    try:
+        cPickle.dump( state, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename( fname + '.tmp', fname)
+
+# Returns the state last saved by checkpoint() (or default)
+def restore( name, default = None):
+    if checkpoint_dir is None:
+        return default
+    try:
+        f = open( os.path.join( checkpoint_dir, name + '.ckpt'), 'rb')
+    except IOError:
+        return default
+    try:
+        return cPickle.load( f)
+    finally:
+        f.close()
+
+# Removes a checkpoint once the driver completed
+def clear_checkpoint( name):
+    if checkpoint_dir is None:
+        return
+    try:
+        os.remove( os.path.join( checkpoint_dir, name + '.ckpt'))
+    except OSError:
+        pass
 
 def info( msg):
 	print 'INFO: ' + msg;
@@ -19,7 +19,12 @@ __all__ = ['Reader', 'ReaderError']
 
 from error import YAMLError, Mark
 
-import codecs, re
+import codecs, re, os
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
 
 # Unfortunately, codec functions in Python 2.3 does not support the `finish`
 # arguments, so we have to write our own wrappers.
@@ -89,6 +94,10 @@ class Reader(object):
     #  - a file-like object with its `read` method returning `str`,
     #  - a file-like object with its `read` method returning `unicode`.
 
+    # Regular files are mapped in memory (see `map_file`) and decoded at once
+    # into a single unicode buffer, so that reading them never refills or
+    # copies the buffer: peek/prefix/forward only move `pointer`.
+
     # Yeah, it's ugly and slow.
 
     def __init__(self, stream):
@@ -112,6 +121,8 @@ class Reader(object):
             self.name = "<string>"
             self.raw_buffer = stream
             self.determine_encoding()
+        elif self.map_file(stream):
+            self.name = getattr(stream, 'name', "<file>")
         else:
             self.stream = stream
             self.name = getattr(stream, 'name', "<file>")
@@ -131,9 +142,17 @@ class Reader(object):
             self.update(length)
         return self.buffer[self.pointer:self.pointer+length]
 
+    SPECIAL = re.compile(u'[\r\n\x85\u2028\u2029\uFEFF]')
     def forward(self, length=1):
         if self.pointer+length+1 >= len(self.buffer):
             self.update(length+1)
+        if length > 1 and not self.SPECIAL.search(self.buffer,
+                self.pointer, self.pointer+length):
+            # No line break: only the column changes.
+            self.pointer += length
+            self.index += length
+            self.column += length
+            return
         while length:
             ch = self.buffer[self.pointer]
             self.pointer += 1
@@ -169,6 +188,41 @@ class Reader(object):
                 self.encoding = 'utf-8'
         self.update(1)
 
+    def map_file(self, stream):
+        # Decodes a regular file read from its start through mmap. Returns
+        # False (leaving the stream untouched) if it cannot be mapped.
+        if mmap is None:
+            return False
+        try:
+            fileno = stream.fileno()
+            if stream.tell() != 0 or os.fstat(fileno).st_size == 0:
+                return False
+            data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            return False
+        try:
+            if data[:2] == codecs.BOM_UTF16_LE:
+                decode = utf_16_le_decode
+                self.encoding = 'utf-16-le'
+            elif data[:2] == codecs.BOM_UTF16_BE:
+                decode = utf_16_be_decode
+                self.encoding = 'utf-16-be'
+            else:
+                decode = utf_8_decode
+                self.encoding = 'utf-8'
+            self.name = getattr(stream, 'name', "<file>")
+            try:
+                buffer, converted = decode(data, 'strict', True)
+            except UnicodeDecodeError, exc:
+                raise ReaderError(self.name, exc.start, exc.object[exc.start],
+                        exc.encoding, exc.reason)
+        finally:
+            data.close()
+        self.check_printable(buffer)
+        self.buffer = buffer+u'\0'
+        stream.seek(0, 2)
+        return True
+
     NON_PRINTABLE = re.compile(u'[^\x09\x0A\x0D\x20-\x7E\x85\xA0-\uD7FF\uE000-\uFFFD]')
     def check_printable(self, data):
         match = self.NON_PRINTABLE.search(data)
@@ -209,7 +263,7 @@ class Reader(object):
                 self.raw_buffer = None
                 break
 
-    def update_raw(self, size=1024):
+    def update_raw(self, size=65536):
         data = self.stream.read(size)
         if data:
             self.raw_buffer += data
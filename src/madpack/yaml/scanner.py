@@ -29,6 +29,8 @@ __all__ = ['Scanner', 'ScannerError']
 from error import MarkedYAMLError
 from tokens import *
 
+import re
+
 class ScannerError(MarkedYAMLError):
     pass
 
@@ -165,87 +167,12 @@ class Scanner(object):
         # Peek the next character.
         ch = self.peek()
 
-        # Is it the end of stream?
-        if ch == u'\0':
-            return self.fetch_stream_end()
-
-        # Is it a directive?
-        if ch == u'%' and self.check_directive():
-            return self.fetch_directive()
-
-        # Is it the document start?
-        if ch == u'-' and self.check_document_start():
-            return self.fetch_document_start()
-
-        # Is it the document end?
-        if ch == u'.' and self.check_document_end():
-            return self.fetch_document_end()
-
-        # TODO: support for BOM within a stream.
-        #if ch == u'\uFEFF':
-        #    return self.fetch_bom()    <-- issue BOMToken
-
-        # Note: the order of the following checks is NOT significant.
-
-        # Is it the flow sequence start indicator?
-        if ch == u'[':
-            return self.fetch_flow_sequence_start()
-
-        # Is it the flow mapping start indicator?
-        if ch == u'{':
-            return self.fetch_flow_mapping_start()
-
-        # Is it the flow sequence end indicator?
-        if ch == u']':
-            return self.fetch_flow_sequence_end()
-
-        # Is it the flow mapping end indicator?
-        if ch == u'}':
-            return self.fetch_flow_mapping_end()
-
-        # Is it the flow entry indicator?
-        if ch == u',':
-            return self.fetch_flow_entry()
-
-        # Is it the block entry indicator?
-        if ch == u'-' and self.check_block_entry():
-            return self.fetch_block_entry()
-
-        # Is it the key indicator?
-        if ch == u'?' and self.check_key():
-            return self.fetch_key()
-
-        # Is it the value indicator?
-        if ch == u':' and self.check_value():
-            return self.fetch_value()
-
-        # Is it an alias?
-        if ch == u'*':
-            return self.fetch_alias()
-
-        # Is it an anchor?
-        if ch == u'&':
-            return self.fetch_anchor()
-
-        # Is it a tag?
-        if ch == u'!':
-            return self.fetch_tag()
-
-        # Is it a literal scalar?
-        if ch == u'|' and not self.flow_level:
-            return self.fetch_literal()
-
-        # Is it a folded scalar?
-        if ch == u'>' and not self.flow_level:
-            return self.fetch_folded()
-
-        # Is it a single quoted scalar?
-        if ch == u'\'':
-            return self.fetch_single()
-
-        # Is it a double quoted scalar?
-        if ch == u'\"':
-            return self.fetch_double()
+        # Is it an indicator? See FETCHERS for the checks made for each
+        # character (the order of the checks for the same character is 
+        # significant).
+        for check, fetch in self.FETCHERS.get(ch, ()):
+            if check is None or getattr(self, check)():
+                return getattr(self, fetch)()
 
         # It must be a plain scalar then.
         if self.check_plain():
@@ -256,6 +183,33 @@ class Scanner(object):
                 "found character %r that cannot start any token"
                 % ch.encode('utf-8'), self.get_mark())
 
+    # The token dispatch table of `fetch_more_tokens`: the first character of
+    # a token -> list of (check, fetch) method names. The first entry whose
+    # check succeeds (or is None) fetches the token; if none does, the
+    # token must be a plain scalar.
+    # TODO: support for BOM within a stream (u'\uFEFF' -> BOMToken).
+    FETCHERS = {
+        u'\0':  [(None, 'fetch_stream_end')],
+        u'%':   [('check_directive', 'fetch_directive')],
+        u'-':   [('check_document_start', 'fetch_document_start'),
+                 ('check_block_entry', 'fetch_block_entry')],
+        u'.':   [('check_document_end', 'fetch_document_end')],
+        u'[':   [(None, 'fetch_flow_sequence_start')],
+        u'{':   [(None, 'fetch_flow_mapping_start')],
+        u']':   [(None, 'fetch_flow_sequence_end')],
+        u'}':   [(None, 'fetch_flow_mapping_end')],
+        u',':   [(None, 'fetch_flow_entry')],
+        u'?':   [('check_key', 'fetch_key')],
+        u':':   [('check_value', 'fetch_value')],
+        u'*':   [(None, 'fetch_alias')],
+        u'&':   [(None, 'fetch_anchor')],
+        u'!':   [(None, 'fetch_tag')],
+        u'|':   [('check_block_scalar', 'fetch_literal')],
+        u'>':   [('check_block_scalar', 'fetch_folded')],
+        u'\'':  [(None, 'fetch_single')],
+        u'\"':  [(None, 'fetch_double')],
+    }
+
     # Simple keys treatment.
 
     def next_possible_simple_key(self):
@@ -728,6 +682,11 @@ class Scanner(object):
         else:
             return self.peek(1) in u'\0 \t\r\n\x85\u2028\u2029'
 
+    def check_block_scalar(self):
+
+        # LITERAL, FOLDED:  '|', '>' (block context only)
+        return not self.flow_level
+
     def check_plain(self):
 
         # A plain scalar may start with any non-space character except:
@@ -747,6 +706,33 @@ class Scanner(object):
                 or (self.peek(1) not in u'\0 \t\r\n\x85\u2028\u2029'
                         and (ch == u'-' or (not self.flow_level and ch in u'?:')))
 
+    # Bulk scanning: runs of characters that need no further checks are 
+    # matched with the following expressions on the buffer of the Reader.
+
+    # Spaces.
+    SPACES = re.compile(u' *')
+
+    # The rest of a comment.
+    COMMENT = re.compile(u'[^\x00\r\n\x85\u2028\u2029]*')
+
+    # Plain scalar characters in the block context (':' only if it is not
+    # followed by a space or a line break).
+    PLAIN_BLOCK = re.compile(u'(?:[^\x00 \t\r\n\x85\u2028\u2029:]'
+                             u'|:(?![\x00 \t\r\n\x85\u2028\u2029]))*')
+
+    # Plain scalar characters in the flow context.
+    PLAIN_FLOW = re.compile(u'[^\x00 \t\r\n\x85\u2028\u2029,:?\\[\\]{}]*')
+
+    def match_length(self, regex):
+        # Returns the length of the match of `regex` at the current position.
+        # The match is only final if it stops before the last character of
+        # the buffer (the next characters may otherwise not be read yet).
+        while True:
+            end = regex.match(self.buffer, self.pointer).end()
+            if end+1 < len(self.buffer) or self.raw_buffer is None:
+                return end-self.pointer
+            self.update(len(self.buffer)-self.pointer+1)
+
     # Scanners.
 
     def scan_to_next_token(self):
@@ -773,11 +759,10 @@ class Scanner(object):
             self.forward()
         found = False
         while not found:
-            while self.peek() == u' ':
-                self.forward()
+            if self.peek() == u' ':
+                self.forward(self.match_length(self.SPACES))
             if self.peek() == u'#':
-                while self.peek() not in u'\0\r\n\x85\u2028\u2029':
-                    self.forward()
+                self.forward(self.match_length(self.COMMENT))
             if self.scan_line_break():
                 if not self.flow_level:
                     self.allow_simple_key = True
@@ -1288,17 +1273,13 @@ class Scanner(object):
         #    indent = 1
         spaces = []
         while True:
-            length = 0
             if self.peek() == u'#':
                 break
-            while True:
-                ch = self.peek(length)
-                if ch in u'\0 \t\r\n\x85\u2028\u2029'   \
-                        or (not self.flow_level and ch == u':' and
-                                self.peek(length+1) in u'\0 \t\r\n\x85\u2028\u2029') \
-                        or (self.flow_level and ch in u',:?[]{}'):
-                    break
-                length += 1
+            if self.flow_level:
+                length = self.match_length(self.PLAIN_FLOW)
+            else:
+                length = self.match_length(self.PLAIN_BLOCK)
+            ch = self.peek(length)
             # It's not clear what we should do with ':' in the flow context.
             if (self.flow_level and ch == u':'
                     and self.peek(length+1) not in u'\0 \t\r\n\x85\u2028\u2029,[]{}'):
@@ -1324,9 +1305,7 @@ class Scanner(object):
         # The specification is really confusing about tabs in plain scalars.
         # We just forbid them completely. Do not use tabs in YAML!
         chunks = []
-        length = 0
-        while self.peek(length) in u' ':
-            length += 1
+        length = self.match_length(self.SPACES)
         whitespaces = self.prefix(length)
         self.forward(length)
         ch = self.peek()
@@ -1340,7 +1319,7 @@ class Scanner(object):
             breaks = []
             while self.peek() in u' \r\n\x85\u2028\u2029':
                 if self.peek() == ' ':
-                    self.forward()
+                    self.forward(self.match_length(self.SPACES))
                 else:
                     breaks.append(self.scan_line_break())
                     prefix = self.prefix(3)